@@ -2,12 +2,16 @@
 from __future__ import print_function
 
 import subprocess as sp
+import multiprocessing
+import time
+import collections
 import gevent
 import gevent.wsgi
 import gevent.queue
 import flask
 import flask_socketio
 import json
+import base64
 import nest_utils as nu
 
 VERSION = sp.check_output(["git", "describe", "--tags", "--dirty"]).strip()
@@ -17,10 +21,32 @@ socketio = flask_socketio.SocketIO(app, async_mode='gevent')
 interface = {}
 busy = []
 BUSY_ERRORCODE = 418
+UPDATE_RATE = 10.  # Target number of streamed updates per second
+PIPELINE_DEPTH = 2  # Number of streamed simulation steps in flight
+RESULT_TIMEOUT = 600.  # Seconds to wait for the results of a simulation
+CLIENT_POOL_SIZE = 2  # Number of idle NEST clients kept ready
+client_pool = None  # Started by get_client_pool, when the server starts
+# Number of cores NEST workloads from all users may use at the same time
+CORE_BUDGET = multiprocessing.cpu_count()
+scheduler = nu.JobScheduler(CORE_BUDGET, socketio=socketio)
+placement = nu.CPUPlacement()
 subscriptions = {}
 abort_sub = {}
 
 
+def get_client_pool():
+    """
+    Gets the pool of idle NEST clients, starting it the first time. The pool
+    starts NEST clients, so it is not started when the module is imported.
+
+    :returns: the :class:`nest_utils.NESTClientPool`
+    """
+    global client_pool
+    if client_pool is None:
+        client_pool = nu.NESTClientPool(CLIENT_POOL_SIZE, socketio=socketio)
+    return client_pool
+
+
 def emit_exception(exception, user_id):
     print('An exception was raised:', exception)
     socketio.emit('message',
@@ -49,29 +75,71 @@ def index():
 @app.route('/makeNetwork', methods=['POST'])
 def make_network():
     """
-    Receives the network and construct the interface.
+    Receives the network and construct the interface. If the user already
+    has an interface, its NEST client is reused, and the network is only
+    remade if it has changed. The body of the request is the network, which
+    is passed on to the NEST client as it is, without being decoded here.
+    The user ID is given in the query string. Responds with status 400 if
+    the network is invalid, and 500 if it could not be made.
     """
-    data = flask.request.json
-    user_id = int(data['userID'])
+    user_id = int(flask.request.args['userID'])
     print('User ID: {}'.format(user_id))
     global interface
 
     try:
+        specs = flask.request.get_data(cache=False)
+        spec_hash = nu.hash_network_specs(specs)
         if user_id in interface:
-            interface[user_id].cease_threads()
-            interface[user_id].terminate_nest_client()
-
-        interface[user_id] = nu.NESTInterface(json.dumps(data['network']),
-                                              user_id,
-                                              socketio=socketio)
-
+            if interface[user_id].spec_hash == spec_hash:
+                print('Network unchanged, reusing NEST client')
+            elif user_id in busy:
+                print("Cannot make network, NEST is busy!")
+                return flask.Response(status=BUSY_ERRORCODE)
+            else:
+                # Remake the network in the existing client, instead of
+                # starting a new one.
+                busy.append(user_id)
+                try:
+                    cores = interface[user_id].get_num_cores()
+                    with scheduler.job(user_id, cores):
+                        interface[user_id].assign(user_id, specs)
+                finally:
+                    busy.remove(user_id)
+        else:
+            interface[user_id] = get_client_pool().acquire(user_id, specs)
+            placement.add(user_id, interface[user_id])
+
+    except ValueError as exception:
+        emit_exception(exception, user_id)
+        return flask.Response(status=400)
     except Exception as exception:
         emit_exception(exception, user_id)
+        return flask.Response(status=500)
 
     print(interface)
     return flask.Response(status=204)
 
 
+@app.route('/clientPool', methods=['GET'])
+def client_pool_status():
+    """
+    Sends the hit and miss counters and spawn latencies of the pool of idle
+    NEST clients.
+    """
+    return flask.jsonify(get_client_pool().get_stats())
+
+
+@app.route('/timings/<int:user_id>', methods=['GET'])
+def timings(user_id):
+    """
+    Sends how long each phase of the last build, connect and simulation step
+    of the user's NEST client took, and the number of connections.
+    """
+    if user_id not in interface:
+        return flask.Response(status=404)
+    return flask.jsonify(interface[user_id].get_timings())
+
+
 @app.route('/selector', methods=['POST', 'GET'])
 def print_GIDs():
     """
@@ -97,6 +165,51 @@ def print_GIDs():
         return flask.Response(status=204)
 
 
+@app.route('/selectorBatch', methods=['POST'])
+def get_GIDs_batch():
+    """
+    Receives several selected areas, and sends back the number of GIDs in
+    each of them, and the lowest and highest GID, all in one request. If the
+    GIDs could not be got, responds with status 500.
+    """
+    data = flask.request.json
+    user_id = int(data['userID'])
+
+    global busy
+    try:
+        if user_id in busy:
+            print("Cannot select, NEST is busy!")
+            return flask.Response(status=BUSY_ERRORCODE)
+        busy.append(user_id)
+        try:
+            selections = interface[user_id].get_gids_batch(
+                json.dumps(data['selections']))
+        finally:
+            busy.remove(user_id)
+    except Exception as exception:
+        emit_exception(exception, user_id)
+        return flask.Response(status=500)
+    return flask.jsonify(selections=selections)
+
+
+@app.route('/selectionPreview', methods=['POST'])
+def selection_preview():
+    """
+    Receives a selected area, and sends back the number of neurons in it, in
+    total, in each layer and of each type. The neurons are counted by the
+    server from the network specifications, without involving NEST, so the
+    preview can be updated while the selection is being made.
+    """
+    data = flask.request.json
+    user_id = int(data['userID'])
+    preview = {}
+    try:
+        preview = interface[user_id].preview_selection(data['info'])
+    except Exception as exception:
+        emit_exception(exception, user_id)
+    return flask.jsonify(preview)
+
+
 @app.route('/connect', methods=['POST'])
 def connect_ajax():
     """
@@ -116,10 +229,11 @@ def connect_ajax():
             print('Projections:')
             print(projections)
 
-            interface[user_id].device_projections = projections
-            interface[user_id].send_device_projections()
+            with scheduler.job(user_id, interface[user_id].get_num_cores()):
+                interface[user_id].device_projections = projections
+                interface[user_id].send_device_projections()
 
-            interface[user_id].connect_all()
+                interface[user_id].connect_all()
         except Exception as exception:
             emit_exception(exception, user_id)
         return flask.Response(status=204)
@@ -159,28 +273,109 @@ def simulate_ajax():
         t = float(data['time'])
 
         busy.append(user_id)
-        interface[user_id].device_projections = projections
-        interface[user_id].send_device_projections()
-        interface[user_id].connect_all()
-
-        print("Simulating for ", t, "ms ...")
-        interface[user_id].simulate(t)
-        interface[user_id].simulate(-1)
-        busy.remove(user_id)
+        try:
+            with scheduler.job(user_id,
+                               interface[user_id].get_num_cores()):
+                interface[user_id].device_projections = projections
+                interface[user_id].send_device_projections()
+                interface[user_id].connect_all()
+
+                print("Simulating for ", t, "ms ...")
+                # The client cleans up after the simulation also if it
+                # failed, so it is not left prepared for the next one.
+                try:
+                    interface[user_id].get_results(
+                        interface[user_id].simulate(t), RESULT_TIMEOUT)
+                except Exception:
+                    interface[user_id].drop_pending_results()
+                    raise
+                finally:
+                    interface[user_id].simulate(-1)
+        finally:
+            busy.remove(user_id)
     except Exception as exception:
         emit_exception(exception, user_id)
 
     return flask.Response(status=204)
 
 
-def g_simulate(network, projections, t, user_id):
+def stream_chunks(t, user_id, binary, q):
+    """
+    Simulates in chunks, and streams the results of each chunk to the user.
+
+    :param t: time to simulate
+    :param user_id: ID of the user
+    :param binary: whether to send results as binary frames over socket.io
+        instead of JSON over Server-Sent Events
+    :param q: queue the simulation is aborted through
+    """
+    chunks = nu.ChunkScheduler(t, target_rate=UPDATE_RATE)
+    # Chunks sent to the client, but not yet received results from.
+    # Up to PIPELINE_DEPTH chunks are in flight, so the client can
+    # simulate the next chunk while the results of the last one are
+    # being handled.
+    in_flight = collections.deque()
+    aborted = False
+    last_received = time.time()
+
+    while True:
+        while (not aborted and not chunks.done() and
+               len(in_flight) < PIPELINE_DEPTH):
+            dt = chunks.next_dt()
+            print(chunks.n_chunks, dt)
+            in_flight.append(
+                (time.time(), interface[user_id].simulate(dt)))
+        if not in_flight:
+            break
+
+        chunk_sent, result = in_flight.popleft()
+        # Waits for the results without blocking other greenlets.
+        device_results = interface[user_id].get_results(
+            result, RESULT_TIMEOUT)
+        received = time.time()
+        if aborted:
+            # Results of chunks started before the abort are
+            # discarded.
+            continue
+        # Time the client spent on this chunk, excluding time spent
+        # waiting behind earlier chunks.
+        chunks.update(received - max(chunk_sent, last_received),
+                      len(device_results))
+        last_received = received
+        if binary:
+            # The frame is passed on as it is, without decoding.
+            if device_results:
+                socketio.emit(
+                    'simulation_data',
+                    base64.b64decode(device_results),
+                    namespace='/simulationData/{}'.format(user_id))
+        else:
+            results = json.loads(device_results)
+            if results:
+                jsonResult = flask.json.dumps(results)
+                if user_id in subscriptions:
+                    subscriptions[user_id].put(jsonResult)
+        # Yield this context to check abort and send data
+        gevent.sleep()
+        if not q.empty():
+            abort = q.get()
+            if abort:
+                print("Simulation aborted")
+                aborted = True
+
+
+def g_simulate(projections, t, user_id, binary=False):
     """
     Runs a simulation in steps. This way the client can be updated on the
-    status of the simulation.
+    status of the simulation. The length of each step is adapted to send
+    about ``UPDATE_RATE`` updates per second, and up to ``PIPELINE_DEPTH``
+    steps are sent to the NEST client ahead of the results. Setting
+    ``PIPELINE_DEPTH`` to 1 runs the steps one at a time.
 
-    :param network: network specifications
     :param projections: projections between layers and devices
     :param t: time to simulate
+    :param binary: whether to send results as binary frames over socket.io
+        instead of JSON over Server-Sent Events
     """
     global interface
     global busy
@@ -188,47 +383,37 @@ def g_simulate(network, projections, t, user_id):
 
     try:
         busy.append(user_id)
+        try:
+            q = gevent.queue.Queue()
+            abort_sub[user_id] = q
+
+            with scheduler.job(user_id, interface[user_id].get_num_cores()):
+                interface[user_id].device_projections = projections
+                interface[user_id].send_device_projections()
+                interface[user_id].connect_all()
+                if binary:
+                    interface[user_id].set_result_format('binary')
+
+                # The client cleans up and the result format is restored
+                # however the simulation ends, so that the client is not left
+                # prepared, and later simulations do not get binary frames.
+                try:
+                    stream_chunks(t, user_id, binary, q)
+                except Exception:
+                    interface[user_id].drop_pending_results()
+                    raise
+                finally:
+                    interface[user_id].simulate(-1)
+                    if binary:
+                        interface[user_id].set_result_format('json')
+        finally:
+            busy.remove(user_id)
 
-        interface[user_id].device_projections = projections
-        interface[user_id].send_device_projections()
-        interface[user_id].connect_all()
-        interface[user_id].device_results = '{}'
-
-        q = gevent.queue.Queue()
-        abort_sub[user_id] = q
-
-        steps = 1000
-        sleep_t = 0.1  # sleep time
-        dt = float(t) / steps
-
-        for i in range(steps):
-            print(i)
-            if not q.empty():
-                abort = q.get()
-                if abort:
-                    print("Simulation aborted")
-                    break
-            interface[user_id].simulate(dt)
-            device_results = None
-            while device_results is None:
-                device_results = interface[user_id].get_device_results()
-                if device_results is None:
-                    # Waiting for results
-                    gevent.sleep(sleep_t)
-            results = json.loads(device_results)
-            if results:
-                jsonResult = flask.json.dumps(results)
-                if user_id in subscriptions:
-                    subscriptions[user_id].put(jsonResult)
-            interface[user_id].device_results = '{}'
-            # Yield this context to check abort and send data
-            gevent.sleep(sleep_t)
-
-        interface[user_id].simulate(-1)
-
-        busy.remove(user_id)
-
-        if user_id in subscriptions:
+        if binary:
+            socketio.emit('simulation_end',
+                          {'simulation_end': True},
+                          namespace='/simulationData/{}'.format(user_id))
+        elif user_id in subscriptions:
             subscriptions[user_id].put(
                 flask.json.dumps({"simulation_end": True}))
     except Exception as exception:
@@ -241,7 +426,6 @@ def streamSimulate():
     Receive data from the client and run a simulation in steps.
     """
     data = flask.request.json
-    network = json.dumps(data['network'])
     projections = json.dumps(data['projections'])
     user_id = int(data['userID'])
     try:
@@ -250,9 +434,10 @@ def streamSimulate():
             return flask.Response(status=BUSY_ERRORCODE)
 
         t = data['time']
+        binary = bool(data.get('binary', False))
 
         print("Simulating for ", t, "ms")
-        gevent.spawn(g_simulate, network, projections, t, user_id)
+        gevent.spawn(g_simulate, projections, t, user_id, binary)
     except Exception as exception:
         emit_exception(exception, user_id)
     return flask.Response(status=204)
@@ -284,6 +469,9 @@ def simulationData(user_id):
         try:
             q = gevent.queue.Queue()
             subscriptions[user_id] = q
+            # The session is active while the user is listening.
+            if user_id in interface and user_id not in placement.sessions:
+                placement.add(user_id, interface[user_id])
             try:
                 while True:
                     result = q.get()
@@ -291,12 +479,14 @@ def simulationData(user_id):
                     yield ev
             except GeneratorExit:
                 del subscriptions[user_id]
+                placement.remove(user_id)
         except Exception as exception:
             emit_exception(exception, user_id)
     return flask.Response(gen(), mimetype="text/event-stream")
 
 
 if __name__ == '__main__':
+    get_client_pool()
     socketio.run(app,
                  host="",
                  port=7000,
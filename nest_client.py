@@ -1,10 +1,18 @@
 from __future__ import print_function
 import __builtin__  # for Python 3: builtins as __builtin__
+import os
 import sys
 import json
+import time
+import hashlib
+import contextlib
+import collections
+import tempfile
+import threading
+import Queue  # for Python 3: queue as Queue
+import struct
+import base64
 import gevent
-import numbers
-import math
 import numpy as np
 import random
 import traceback as tb
@@ -13,6 +21,34 @@ import float_message_pb2 as fm
 import string_message_pb2 as sm
 import nest
 import nest.topology as tp
+import network_specs
+
+try:
+    from mpi4py import MPI
+except ImportError:
+    MPI = None
+
+# Maximum number of simulation results waiting to be sent to the server.
+RESULTS_QUEUE_SIZE = 2
+# Maximum number of devices left over from earlier connects before the
+# network is rebuilt from scratch.
+MAX_RETIRED_DEVICES = 50
+# Directory of the connectome cache, which is disabled if this is not set,
+# and the maximum size of the cache in megabytes.
+CONNECTOME_CACHE_DIR = os.environ.get('NEST_CONNECTOME_CACHE')
+CONNECTOME_CACHE_SIZE = float(os.environ.get('NEST_CONNECTOME_CACHE_SIZE',
+                                             1024))
+# Prefix of the temporary files connectomes are written to before they are
+# moved into the connectome cache.
+CONNECTOME_TEMP_PREFIX = 'tmp'
+# Version of the format of cached connectomes, which is part of their keys,
+# so connectomes saved in an older format are not used.
+CONNECTOME_FORMAT = 2
+# Maximum number of selections kept in the selection cache.
+SELECTION_CACHE_SIZE = 256
+# Prefix of the results sent instead of device results when getting or
+# sending them failed. Must match ERROR_RESULT_PREFIX in nest_utils.
+ERROR_RESULT_PREFIX = 'error '
 
 
 # redefine print
@@ -67,24 +103,10 @@ class observe_slot(gevent.Greenlet):
         function in the client.
         """
         try:
-            msg_type = self.msg.value.split()[0]
-            msg_data = " ".join(self.msg.value.split()[1:])
-            if msg_type == 'reset':
-                self.client.handle_reset()
-            elif msg_type == 'projections':
-                self.client.handle_recv_projections(msg_data)
-            elif msg_type == 'make_network':
-                self.client.handle_make_network_specs(msg_data)
-            elif msg_type == 'get_gids':
-                self.client.handle_get_gids(msg_data)
-            elif msg_type == 'connect':
-                self.client.handle_connect()
-            elif msg_type == 'get_nconnections':
-                self.client.handle_get_nconnections()
-            elif msg_type == 'simulate':
-                self.client.handle_simulate(msg_data)
-            elif msg_type == 'ping':
-                self.client.handle_ping()
+            # Only split off the type, as the data may be a large network.
+            msg_type, _, msg_data = self.msg.value.partition(' ')
+            self.client.broadcast_command(msg_type, msg_data)
+            self.client.handle_command(msg_type, msg_data)
         except Exception as exception:
             print('An exception was raised:', exception)
             self.client.send_status_message(
@@ -92,7 +114,8 @@ class observe_slot(gevent.Greenlet):
                                    type(exception).__name__,
                                    exception.args[0]))
             tb.print_exc()
-            self.client.send_complete_signal()
+            self.client.send_error_replies(exception)
+            self.client.send_complete_signal(failed=True)
 
     def run(self):
         """
@@ -112,25 +135,519 @@ class observe_slot(gevent.Greenlet):
             # gevent.sleep()  # Yield context to let other greenlets work.
 
 
+def concatenate_arrays(arrays, dtype=np.float64):
+    """
+    Concatenates event arrays from several recording devices.
+
+    :param arrays: List of arrays, possibly empty
+    :param dtype: Type of the returned array
+    :returns: the concatenated array
+    """
+    if not arrays:
+        return np.array([], dtype=dtype)
+    return np.concatenate(arrays).astype(dtype, copy=False)
+
+
+def group_by_time(times, senders, values):
+    """
+    Groups values recorded from several senders by time, as a dense matrix
+    with a row for each time and a column for each sender. Values that were
+    not recorded are NaN.
+
+    :param times: Array of recording times
+    :param senders: Array of senders, one per time
+    :param values: Array of recorded values, one per time
+    :returns: a tuple of the sorted unique times, the sorted unique senders
+        and the matrix of values
+    """
+    unique_times, time_index = np.unique(times, return_inverse=True)
+    unique_senders, sender_index = np.unique(senders, return_inverse=True)
+    matrix = np.full((unique_times.size, unique_senders.size), np.nan)
+    matrix[time_index, sender_index] = values
+    return unique_times, unique_senders, matrix
+
+
+def array_to_list(array):
+    """
+    Converts an array to a list that can be encoded as JSON, with NaN values
+    as `None`.
+
+    :param array: Array to convert
+    :returns: the values of the array as a, possibly nested, list
+    """
+    if array.dtype.kind == 'f':
+        missing = np.isnan(array)
+        if missing.any():
+            return np.where(missing, None, array).tolist()
+    return array.tolist()
+
+
+def encode_results_json(results):
+    """
+    Encodes device results as JSON. The event arrays are converted to lists
+    as the results are serialized.
+
+    :param results: Device results, as returned by
+                    :meth:`NESTClient.get_device_results`
+    :returns: the JSON encoded results
+    """
+    return json.dumps(results, default=array_to_list)
+
+
+def encode_error_result(exception):
+    """
+    Encodes an exception as an error result, sent in place of device results
+    so that the server does not wait for results that never come.
+
+    :param exception: The exception raised
+    :returns: the error result
+    """
+    return ERROR_RESULT_PREFIX + '{}: {}'.format(type(exception).__name__,
+                                                 exception)
+
+
+def encode_results_frame(results):
+    """
+    Encodes device results as a binary frame, base64 encoded so it can be
+    sent in a string message. The frame consists of
+
+    * the length of the header, as a little-endian uint32,
+    * a JSON header, padded with spaces to a multiple of 8 bytes, and
+    * the arrays, each starting at a multiple of 8 bytes.
+
+    The header holds the simulation time, the dtype, offset from the end of
+    the header and length of each named array, and the names of the recording
+    devices in the results.
+
+    :param results: Device results, as returned by
+                    :meth:`NESTClient.get_device_results`
+    :returns: the base64 encoded frame, or an empty string if there are no
+        results
+    """
+    if results is None:
+        return ''
+    stream_results = results['stream_results']
+    plot_results = results['plot_results']
+    header = {'time': plot_results['time'],
+              'devices': sorted(stream_results.keys()),
+              'arrays': {}}
+    body = []
+    offset = [0]
+
+    def add_array(name, values, dtype):
+        array = np.ascontiguousarray(values, dtype=dtype)
+        header['arrays'][name] = [array.dtype.str, offset[0], array.size]
+        data = array.tobytes()
+        padding = -len(data) % 8
+        body.append(data + b'\0' * padding)
+        offset[0] += len(data) + padding
+
+    for device_name, events in stream_results.items():
+        add_array(device_name + '/senders', events['senders'], '<i4')
+        add_array(device_name + '/times', events['times'], '<f8')
+        if 'V_m' in events:
+            add_array(device_name + '/V_m', events['V_m'], '<f4')
+
+    spike_det = plot_results['spike_det']
+    add_array('spike_det/senders', spike_det['senders'], '<i4')
+    add_array('spike_det/times', spike_det['times'], '<f8')
+    rec_dev = plot_results['rec_dev']
+    add_array('rec_dev/times', rec_dev['times'], '<f8')
+    add_array('rec_dev/senders', rec_dev['senders'], '<i4')
+    add_array('rec_dev/V_m', rec_dev['V_m'], '<f4')
+    lfp_det = plot_results['lfp_det']
+    add_array('lfp_det/times', lfp_det['times'], '<f8')
+    for ch in range(16):
+        add_array('lfp_det/{}/lfp'.format(ch), lfp_det[str(ch)]['lfp'], '<f4')
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    header_bytes += b' ' * (-(len(header_bytes) + 4) % 8)
+    frame = (struct.pack('<I', len(header_bytes)) + header_bytes +
+             b''.join(body))
+    return base64.b64encode(frame)
+
+
+def merge_device_results(results_list):
+    """
+    Merges device results from several MPI ranks. Each rank records the
+    events of its own neurons, so the events are combined, and voltmeter
+    values are grouped by time again.
+
+    :param results_list: List of device results, as returned by
+                         :meth:`NESTClient.get_device_results`, one per rank
+    :returns: the merged results, or `None` if there are no results
+    """
+    results_list = [results for results in results_list if results is not None]
+    if not results_list:
+        return None
+    if len(results_list) == 1:
+        return results_list[0]
+
+    def merged(arrays_list, dtype=np.float64):
+        return concatenate_arrays(list(arrays_list), dtype)
+
+    stream_results = {}
+    for results in results_list:
+        for device_name, events in results['stream_results'].items():
+            stream_results.setdefault(device_name, []).append(events)
+    for device_name, events_list in stream_results.items():
+        stream_results[device_name] = {
+            column: merged((events[column] for events in events_list),
+                           np.int64 if column == 'senders' else np.float64)
+            for column in events_list[0]}
+
+    plot_list = [results['plot_results'] for results in results_list]
+    # The voltmeter matrices are taken apart into their recorded values, and
+    # grouped again.
+    vm_times = []
+    vm_senders = []
+    vm_values = []
+    for plot_results in plot_list:
+        rec_dev = plot_results['rec_dev']
+        recorded = ~np.isnan(rec_dev['V_m'])
+        time_index, sender_index = np.nonzero(recorded)
+        vm_times.append(rec_dev['times'][time_index])
+        vm_senders.append(rec_dev['senders'][sender_index])
+        vm_values.append(rec_dev['V_m'][recorded])
+    times, senders, V_m = group_by_time(merged(vm_times),
+                                        merged(vm_senders, np.int64),
+                                        merged(vm_values))
+    lfp_det = {str(ch): {'lfp': merged(plot_results['lfp_det'][str(ch)]['lfp']
+                                       for plot_results in plot_list)}
+               for ch in range(16)}
+    lfp_det['times'] = merged(plot_results['lfp_det']['times']
+                              for plot_results in plot_list)
+
+    return {'stream_results': stream_results,
+            'plot_results': {
+                'spike_det': {
+                    'senders': merged((plot_results['spike_det']['senders']
+                                       for plot_results in plot_list),
+                                      np.int64),
+                    'times': merged(plot_results['spike_det']['times']
+                                    for plot_results in plot_list)},
+                'rec_dev': {'times': times, 'senders': senders,
+                            'V_m': V_m},
+                'lfp_det': lfp_det,
+                'time': max(plot_results['time']
+                            for plot_results in plot_list)}}
+
+
+class send_slot(threading.Thread):
+    """
+    A sender of results to the server, running in its own thread. Results are
+    encoded and sent by the thread, so the client can start on the next task
+    while the previous results are still being shipped.
+
+    :param slot: The nett type slot to send on
+    :param maxsize: Maximum number of results waiting to be sent. If the queue
+                    is full, :meth:`put` blocks.
+    """
+
+    def __init__(self, slot, maxsize=2):
+        super(send_slot, self).__init__()
+        self.slot = slot
+        self.queue = Queue.Queue(maxsize)
+        self.daemon = True
+
+    def put(self, data, encode=json.dumps):
+        """
+        Queues data to be sent.
+
+        :param data: Data to send
+        :param encode: Function encoding the data to a string. Defaults to
+                       JSON encoding.
+        """
+        self.queue.put((data, encode))
+
+    def put_error(self, exception):
+        """
+        Queues an error result, see :func:`encode_error_result`, to be sent in
+        order with the other data.
+
+        :param exception: The exception raised
+        """
+        self.put(exception, encode_error_result)
+
+    def wait_until_sent(self):
+        """
+        Blocks until all queued data is sent.
+        """
+        self.queue.join()
+
+    def send(self, value):
+        """
+        Sends a string on the slot.
+
+        :param value: String to send
+        """
+        msg = sm.string_message()
+        msg.value = value
+        self.slot.send(msg.SerializeToString())
+
+    def run(self):
+        """
+        Runs the thread. If encoding or sending data fails, an error result is
+        sent instead, and the thread carries on with the next data.
+        """
+        while True:
+            data, encode = self.queue.get()
+            try:
+                self.send(encode(data))
+            except Exception as exception:
+                print('An exception was raised while sending:', exception)
+                tb.print_exc()
+                try:
+                    self.send(encode_error_result(exception))
+                except Exception:
+                    tb.print_exc()
+            finally:
+                self.queue.task_done()
+
+
+class ConnectomeCache(object):
+    """
+    Cache of connectomes on disk, as compressed arrays of sources, targets,
+    weights, delays, receptors and synapse models. When the cache grows
+    beyond its maximum size, the least recently used connectomes are removed.
+
+    :param directory: Directory to keep the connectomes in
+    :param max_size: Maximum total size of the cached files, in bytes
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def get_path(self, key):
+        """
+        Gets the path of the file of a connectome.
+
+        :param key: Key of the connectome
+        :returns: path of the file
+        """
+        return os.path.join(self.directory, key + '.npz')
+
+    def load(self, key):
+        """
+        Loads a connectome, and marks it as recently used.
+
+        :param key: Key of the connectome
+        :returns: dictionary of arrays, or `None` if the connectome is not in
+            the cache
+        """
+        path = self.get_path(key)
+        try:
+            with np.load(path) as connectome:
+                arrays = {name: connectome[name] for name in connectome.files}
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return arrays
+
+    def save(self, key, arrays):
+        """
+        Saves a connectome, and removes the least recently used connectomes
+        if the cache has grown too large.
+
+        :param key: Key of the connectome
+        :param arrays: Dictionary of arrays making up the connectome
+        """
+        # Write to a temporary file first, so other clients never see a
+        # partly written connectome.
+        fd, temp_path = tempfile.mkstemp(suffix='.npz',
+                                         prefix=CONNECTOME_TEMP_PREFIX,
+                                         dir=self.directory)
+        with os.fdopen(fd, 'wb') as temp_file:
+            np.savez_compressed(temp_file, **arrays)
+        try:
+            os.rename(temp_path, self.get_path(key))
+        except OSError:
+            # The connectome is just not cached.
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used connectomes until the cache is within
+        its maximum size. Temporary files, which may be connectomes other
+        clients are still writing, are left alone.
+        """
+        entries = []
+        for file_name in os.listdir(self.directory):
+            if (file_name.startswith(CONNECTOME_TEMP_PREFIX) or
+                    not file_name.endswith('.npz')):
+                continue
+            path = os.path.join(self.directory, file_name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total_size -= size
+
+
+def get_selection_key(selection_dict):
+    """
+    Gets a key identifying the geometry of a selection: the layers, the shape
+    and corners of the mask, its angles, and the neuron type. Other
+    properties of the selection, like the synapse model, do not change the
+    selected GIDs.
+
+    :param selection_dict: Dictionary containing specifications of the
+                           selected areas.
+    :returns: tuple identifying the selection
+    """
+    selection = selection_dict['selection']
+    return (tuple(selection_dict['name']),
+            selection_dict['maskShape'],
+            tuple(float(selection['ll'][axis]) for axis in 'xyz'),
+            tuple(float(selection['ur'][axis]) for axis in 'xyz'),
+            float(selection_dict['azimuthAngle']),
+            float(selection_dict.get('polarAngle', 0.)),
+            selection_dict['neuronType'])
+
+
+class SelectionCache(object):
+    """
+    Cache of the GIDs of selections, so that selections shared by several
+    devices, or unchanged between connects, are only looked up once. When
+    the cache is full, the least recently used selection is removed.
+
+    :param max_size: Maximum number of selections kept
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.selections = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Gets the GIDs of a selection, and marks it as recently used.
+
+        :param key: Key of the selection
+        :returns: the GIDs, or `None` if the selection is not in the cache
+        """
+        gids = self.selections.pop(key, None)
+        if gids is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.selections[key] = gids
+        return gids
+
+    def put(self, key, gids):
+        """
+        Adds the GIDs of a selection.
+
+        :param key: Key of the selection
+        :param gids: The selected GIDs
+        """
+        self.selections.pop(key, None)
+        self.selections[key] = gids
+        while len(self.selections) > self.max_size:
+            self.selections.popitem(last=False)
+
+    def clear(self):
+        """
+        Removes all selections, keeping the counters.
+        """
+        self.selections.clear()
+
+    def get_stats(self):
+        """
+        Gets the counters of the cache.
+
+        :returns: dictionary with the number of selections kept, and the hit
+            and miss counts
+        """
+        return {'size': len(self.selections),
+                'hits': self.hits,
+                'misses': self.misses}
+
+
 class NESTClient(object):
     """
     For running NEST. Controlled by NESTInterface.
+
+    :param user_id: ID used for communicating with NESTInterface
+    :param silent: Whether the client should be silent
+    :param port: Optional port to communicate on, as given by NESTInterface.
+                 Defaults to a port picked from the user ID.
     """
 
-    def __init__(self, user_id, silent=False):
+    def __init__(self, user_id, silent=False, port=None):
         nest.set_verbosity("M_ERROR")
         self.user_id = user_id
         self.silent = silent
+        # When running under MPI, only rank 0 communicates with the server,
+        # and passes the commands on to the other ranks.
+        self.rank = nest.Rank()
+        if nest.NumProcesses() > 1:
+            if MPI is None:
+                raise ImportError('mpi4py is needed to run the NEST client '
+                                  'with MPI')
+            self.comm = MPI.COMM_WORLD
+        else:
+            self.comm = None
 
-        random.seed(int(self.user_id))
-        nett.initialize('tcp://127.0.0.1:{}'.format(
-            8000 + random.randint(1, 1000)))
-
-        self.networkSpecs = {}
+        self.network = None
+        self.spec_hash = None
+        self.selector = None
         self.layers = {}
+        self.build_id = 0
+        self.selection_cache = SelectionCache(SELECTION_CACHE_SIZE)
         self.device_projections = None
+        self.num_threads = 1
+        self.kernel_threads = 1
+        self.kernel_seeds = self.get_kernel_seeds()
+        self.network_built = False
+        self.network_pristine = False
+        self.internal_connected = False
+        self.lfp_connected = False
+        self.devices = {}
+        self.retired_devices = []
+        self.result_format = 'json'
+        # Whether the server is waiting for the results of a simulation step.
+        self.awaiting_results = False
+        # Whether the server is waiting for the GIDs of several selections.
+        self.awaiting_selections = False
+        self.timings = []
+        self.connectome_cache = (
+            ConnectomeCache(CONNECTOME_CACHE_DIR,
+                            CONNECTOME_CACHE_SIZE * 2**20)
+            if CONNECTOME_CACHE_DIR else None)
         self.reset_saved_network()
 
+        try:
+            nest.Install('lfpmodule')
+        except nest.NESTError:
+            self.print('LFP module not found.')
+
+        if self.rank != 0:
+            return
+
+        if port is None:
+            random.seed(int(self.user_id))
+            port = 8000 + random.randint(1, 1000)
+        nett.initialize('tcp://127.0.0.1:{}'.format(port))
+
         self.print('Setting up slot messages..')
         self.slot_out_complete = nett.slot_out_float_message(
             'task_complete_{}'.format(self.user_id))
@@ -143,6 +660,15 @@ class NESTClient(object):
         self.slot_out_status_message = (
             nett.slot_out_string_message(
                 'status_message_{}'.format(self.user_id)))
+        self.slot_out_timings = (
+            nett.slot_out_string_message(
+                'timings_{}'.format(self.user_id)))
+        self.slot_out_selections = (
+            nett.slot_out_string_message(
+                'selections_{}'.format(self.user_id)))
+        self.results_sender = send_slot(self.slot_out_device_results,
+                                        RESULTS_QUEUE_SIZE)
+        self.results_sender.start()
 
         self.slot_in_data = nett.slot_in_string_message()
         self.print('Connecting to data input stream..')
@@ -155,11 +681,6 @@ class NESTClient(object):
         self.print('Starting observe slot..')
         observe_slot_data.start()
 
-        try:
-            nest.Install('lfpmodule')
-        except nest.NESTError:
-            self.print('LFP module not found.')
-
         self.send_complete_signal()  # let the server know the client is ready
         gevent.sleep()  # Yield context to let greenlets work.
 
@@ -170,48 +691,215 @@ class NESTClient(object):
         if not self.silent:
             print(*args, **kwargs)
 
+    def handle_command(self, msg_type, msg_data):
+        """
+        Calls the handler of a command from the server.
+
+        :param msg_type: Type of the command
+        :param msg_data: Data sent with the command
+        """
+        self.timings = []
+        if msg_type == 'reset':
+            self.handle_reset()
+        elif msg_type == 'projections':
+            self.handle_recv_projections(msg_data)
+        elif msg_type == 'make_network':
+            self.handle_make_network_specs(msg_data)
+        elif msg_type == 'get_gids':
+            self.handle_get_gids(msg_data)
+        elif msg_type == 'get_gids_batch':
+            self.handle_get_gids_batch(msg_data)
+        elif msg_type == 'connect':
+            self.handle_connect()
+        elif msg_type == 'get_nconnections':
+            self.handle_get_nconnections()
+        elif msg_type == 'simulate':
+            self.handle_simulate(msg_data)
+        elif msg_type == 'set_threads':
+            self.handle_set_threads(msg_data)
+        elif msg_type == 'result_format':
+            self.handle_result_format(msg_data)
+        elif msg_type == 'ping':
+            self.handle_ping()
+        if self.timings:
+            self.send_timings(msg_type)
+
+    def broadcast_command(self, msg_type, msg_data):
+        """
+        Passes a command from the server on to the other MPI ranks. Does
+        nothing if not running under MPI.
+
+        :param msg_type: Type of the command
+        :param msg_data: Data sent with the command
+        """
+        if self.comm is not None:
+            self.comm.bcast((msg_type, msg_data), root=0)
+
+    def follow_commands(self):
+        """
+        Handles the commands passed on from rank 0, on the other MPI ranks.
+        """
+        while True:
+            msg_type, msg_data = self.comm.bcast(None, root=0)
+            try:
+                self.handle_command(msg_type, msg_data)
+            except Exception as exception:
+                print('Rank {}: An exception was raised:'.format(self.rank),
+                      exception)
+                tb.print_exc()
+
     def handle_ping(self):
         """
         Sends a signal to all slots in the server.
         """
+        if self.rank != 0:
+            return
+        self.results_sender.wait_until_sent()
         for slot, msg in [[self.slot_out_nconnections, fm.float_message()],
                           [self.slot_out_device_results, sm.string_message()],
-                          [self.slot_out_status_message, sm.string_message()]]:
+                          [self.slot_out_status_message, sm.string_message()],
+                          [self.slot_out_timings, sm.string_message()],
+                          [self.slot_out_selections, sm.string_message()]]:
             slot.send(msg.SerializeToString())
         self.send_complete_signal()
 
+    @contextlib.contextmanager
+    def timed(self, phase, **info):
+        """
+        Context manager timing a phase of the current command. The timings of
+        a command are sent to NESTInterface when the command is done, see
+        :meth:`send_timings`.
+
+        :param phase: Name of the phase
+        :param info: Optional information about the phase, like the name of
+                     a device
+        :returns: the timing record, to which more information can be added
+        """
+        record = dict(info, phase=phase)
+        start_time = time.time()
+        try:
+            yield record
+        finally:
+            record['time'] = time.time() - start_time
+            self.timings.append(record)
+
+    def send_timings(self, command):
+        """
+        Sends the timings of the phases of a command, the number of
+        connections and the number of threads NEST runs with to
+        NESTInterface.
+
+        :param command: Type of the command
+        """
+        num_connections = self.get_num_connections()
+        if self.rank != 0:
+            return
+        msg = sm.string_message()
+        msg.value = json.dumps({
+            'command': command,
+            'phases': self.timings,
+            'num_connections': num_connections,
+            'kernel_threads': self.kernel_threads,
+            'selection_cache': self.selection_cache.get_stats()})
+        self.slot_out_timings.send(msg.SerializeToString())
+
     def handle_reset(self):
         """
         Resets the NEST kernel.
         """
         self.print("Resetting kernel")
-        nest.ResetKernel()
+        self.reset_kernel()
         self.send_complete_signal()
 
-    def send_complete_signal(self):
+    def reset_kernel(self):
         """
-        Sends a signal to NESTInterface that the current task is complete.
+        Resets the NEST kernel, and sets the number of threads.
         """
+        with self.timed('reset_kernel'):
+            nest.ResetKernel()
+            nest.SetKernelStatus({'local_num_threads': self.num_threads})
+        self.kernel_threads = self.num_threads
+        self.kernel_seeds = self.get_kernel_seeds()
+        self.network_built = False
+        self.network_pristine = False
+        self.internal_connected = False
+        self.lfp_connected = False
+        self.devices = {}
+        self.retired_devices = []
+
+    def get_kernel_seeds(self):
+        """
+        Gets the seeds of the random number generators of the kernel.
+
+        :returns: dictionary of the global and per thread seeds
+        """
+        keys = ['grng_seed', 'rng_seeds']
+        return dict(zip(keys, nest.GetKernelStatus(keys)))
+
+    def handle_set_threads(self, num_threads):
+        """
+        Sets the number of threads NEST should use. As the number of threads
+        can only be changed in an empty network, it takes effect the next
+        time the kernel is reset.
+
+        :param num_threads: Number of threads
+        """
+        self.num_threads = int(num_threads)
+        self.print('Using {} thread(s) from next reset'.format(
+            self.num_threads))
+
+    def send_complete_signal(self, failed=False):
+        """
+        Sends a signal to NESTInterface that the current task is complete. The
+        value of the signal is 1 if the task succeeded, and 0 if it failed.
+
+        :param failed: Whether the task failed
+        """
+        if self.rank != 0:
+            return
         self.print('Sending complete signal')
         msg = fm.float_message()
-        msg.value = 1.
+        msg.value = 0. if failed else 1.
         self.slot_out_complete.send(msg.SerializeToString())
 
     def handle_make_network_specs(self, networkSpecs):
         """
-        Loads the network specifications from JSON format and makes models,
-        nodes, and synapse models.
+        Parses the network specifications from JSON format, validates them,
+        and compiles them to a :class:`network_specs.CompiledSpecs`, which is
+        used from then on. Models, nodes and synapse models are not made until
+        they are needed, see :meth:`ensure_network_built`.
 
         :param networkSpecs: Network specifications
         """
         self.print("Making network specs")
 
-        self.networkSpecs = json.loads(networkSpecs)
+        specs = network_specs.parse(networkSpecs)
+        network_specs.validate(specs)
+        self.network = network_specs.compile_specs(specs)
+        self.selector = network_specs.LayerSelector(self.network)
+        if isinstance(networkSpecs, unicode):
+            networkSpecs = networkSpecs.encode('utf-8')
+        self.spec_hash = hashlib.sha1(networkSpecs).hexdigest()
+        self.network_built = False
+        self.network_pristine = False
+        self.internal_connected = False
+        self.send_complete_signal()
 
+    def ensure_network_built(self):
+        """
+        Makes models, nodes, and synapse models from the network
+        specifications, unless they have already been made.
+        """
+        if self.network_built:
+            return
+        if nest.GetKernelStatus()['network_size'] != 1:
+            # Nodes of an earlier network are still in the kernel.
+            self.reset_kernel()
         self.make_models()
         self.make_nodes()
         self.make_synapse_models()
-        self.send_complete_signal()
+        self.network_built = True
+        self.network_pristine = True
 
     def reset_saved_network(self):
         """
@@ -229,10 +917,11 @@ class NESTClient(object):
 
         # NOTE: We currently do not take parameters from users into account,
         # like 'tau' etc.
-        models = self.networkSpecs['models']
+        models = self.network.models
         self.print(models)
-        for new_mod, old_mod in models.items():
-            nest.CopyModel(old_mod, new_mod)
+        with self.timed('make_models'):
+            for new_mod, old_mod in models:
+                nest.CopyModel(old_mod, new_mod)
 
     def make_synapse_models(self):
         """
@@ -240,9 +929,10 @@ class NESTClient(object):
         """
         self.print("Making synapse models")
 
-        synapses = self.networkSpecs['syn_models']
-        for syn_name, model_name, syn_specs in synapses:
-            nest.CopyModel(syn_name, model_name, syn_specs)
+        synapses = self.network.syn_models
+        with self.timed('make_synapse_models'):
+            for syn_name, model_name, syn_specs in synapses:
+                nest.CopyModel(syn_name, model_name, syn_specs)
 
     def make_nodes(self):
         """
@@ -252,44 +942,24 @@ class NESTClient(object):
 
         # NOTE: We currently do not take parameters from users into account,
         # like 'tau' etc.
-        if nest.GetKernelStatus()['network_size'] == 1:
-
-            for layer in self.networkSpecs['layers']:
-                neurons = layer['neurons']
-                if self.networkSpecs['is3DLayer']:
-                    pos = [[float(neuron['x']),
-                            float(neuron['y']),
-                            float(neuron['z'])]
-                           for neuron in neurons]
-                else:
-                    pos = [[float(neuron['x']), float(neuron['y'])]
-                           for neuron in neurons]
-                model = layer['elements']
-                if isinstance(model, list):
-                    elem = []
-                    for mod in model:
-                        if isinstance(mod, str):
-                            elem.append(self.networkSpecs['models'][mod])
-                        else:
-                            elem.append(mod)
-                    # elem = [ networkSpecs['models'][mod] for mod in model]
-                else:
-                    elem = self.networkSpecs['models'][model]
+        if nest.GetKernelStatus()['network_size'] != 1:
+            return
+        # The GIDs of selections in earlier builds are no longer valid.
+        self.build_id += 1
+        self.selection_cache.clear()
+        with self.timed('make_nodes'):
+            for layer in self.network.layers:
                 # TODO: Use models from make_models!
-
-                extent = layer['extent']
-                center = layer['center']
-                if not self.networkSpecs['is3DLayer']:
-                    extent = extent[:-1]
-                    center = center[:-1]
-                # Going via JSON converts double values to integers, so they
-                # have to be converted back when passing values to NEST.
+                # PyNEST 2 does not take two dimensional arrays as layer
+                # positions, so the array is converted to a list. This is
+                # much faster than building the list from the neuron
+                # dictionaries, see tests/bench_node_positions.py.
                 nest_layer = tp.CreateLayer(
-                    {'positions': pos,
-                     'extent': [float(ext) for ext in extent],
-                     'center': [float(cntr) for cntr in center],
-                     'elements': elem})
-                self.layers[layer['name']] = nest_layer
+                    {'positions': layer.positions.tolist(),
+                     'extent': list(layer.extent),
+                     'center': list(layer.center),
+                     'elements': layer.nest_elements})
+                self.layers[layer.name] = nest_layer
 
     def handle_simulate(self, t):
         """
@@ -297,6 +967,8 @@ class NESTClient(object):
 
         :param t: Time to simulate
         """
+        self.ensure_network_built()
+        self.network_pristine = False
         if not self.prepared_simulation:
             self.print("prepare simulation")
             self.prepare_simulation()
@@ -307,6 +979,7 @@ class NESTClient(object):
             self.cleanup_simulation()
             self.prepared_simulation = False
         else:
+            self.awaiting_results = True
             self.run(t)
             self.send_device_results()
 
@@ -325,7 +998,8 @@ class NESTClient(object):
         """
         nest.SetKernelStatus({'print_time': not self.silent})
 
-        nest.Run(t)
+        with self.timed('run', t=float(t)):
+            nest.Run(t)
 
     def cleanup_simulation(self):
         """
@@ -336,11 +1010,49 @@ class NESTClient(object):
 
     def send_device_results(self):
         """
-        Gets results from the devices and sends them to NESTInterface.
+        Gets results from the devices and sends them to NESTInterface. The
+        results are encoded and sent in the background, so the next simulation
+        step can start right away. Under MPI, the results of all ranks are
+        gathered on rank 0 first.
         """
-        msg = sm.string_message()
-        msg.value = json.dumps(self.get_device_results())
-        self.slot_out_device_results.send(msg.SerializeToString())
+        with self.timed('get_device_results'):
+            results = self.get_device_results()
+        if self.comm is not None:
+            gathered = self.comm.gather(results, root=0)
+            if self.rank != 0:
+                return
+            results = merge_device_results(gathered)
+        encode = (encode_results_frame if self.result_format == 'binary'
+                  else encode_results_json)
+        self.results_sender.put(results, encode)
+        self.awaiting_results = False
+
+    def send_error_replies(self, exception):
+        """
+        Sends errors in place of the replies the server is waiting for, after
+        a command failed, so that the server does not wait for them forever.
+
+        :param exception: The exception raised by the command
+        """
+        if self.awaiting_results:
+            self.awaiting_results = False
+            self.results_sender.put_error(exception)
+        if self.awaiting_selections:
+            self.awaiting_selections = False
+            self.send_selections({'error': '{}: {}'.format(
+                type(exception).__name__, exception)})
+
+    def handle_result_format(self, result_format):
+        """
+        Sets the format device results are sent in.
+
+        :param result_format: Either ``json``, or ``binary`` for base64
+                              encoded binary frames, see
+                              :func:`encode_results_frame`.
+        """
+        if result_format not in ('json', 'binary'):
+            raise ValueError('Invalid result format: %s' % result_format)
+        self.result_format = result_format
 
     def send_status_message(self, message):
         """
@@ -348,6 +1060,8 @@ class NESTClient(object):
 
         :param message: Message to send
         """
+        if self.rank != 0:
+            return
         msg = sm.string_message()
         msg.value = str(message)
         self.slot_out_status_message.send(msg.SerializeToString())
@@ -363,84 +1077,260 @@ class NESTClient(object):
 
     def handle_connect(self):
         """
-        Handles connecting all the network.
+        Handles connecting all the network. If the layers and internal
+        projections are already connected, only the devices are reconnected.
         """
         self.print('Received connect signal')
 
-        # First need to reset kernel, make nodes, models and synapses
-        nest.ResetKernel()
-        self.make_models()
-        self.make_nodes()
-        self.make_synapse_models()
-
-        # Then need to connect
-        self.connect_internal_projections()
+        if self.can_reconnect_devices():
+            self.print('Reconnecting devices only')
+            self.reset_network()
+        else:
+            # First need a freshly built network. Nodes that have not been
+            # connected or simulated yet are used as they are.
+            if not (self.network_pristine and
+                    self.kernel_threads == self.num_threads):
+                self.reset_kernel()
+            self.ensure_network_built()
+            # Then need to connect
+            self.connect_internal_projections()
+            self.internal_connected = True
+
+        self.network_pristine = False
         self.connect_to_devices()
         self.send_complete_signal()
 
+    def can_reconnect_devices(self):
+        """
+        Checks if the built network can be kept, so that only the devices
+        have to be reconnected. This is not the case if the internal network
+        is not connected, if the LFP model is involved, if too many devices
+        have been retired, or if the network has plastic synapses, as
+        resetting the network would not reset their weights. A change of the
+        number of threads does not make the network be rebuilt, but is left
+        for the next time it is rebuilt anyway.
+
+        :returns: `True` if only the devices have to be reconnected
+        """
+        lfp_requested = (self.device_projections is not None and
+                         'LFP' in self.device_projections)
+        return (self.internal_connected and
+                not self.lfp_connected and
+                not lfp_requested and
+                len(self.retired_devices) < MAX_RETIRED_DEVICES and
+                not self.has_plastic_synapses())
+
+    def has_plastic_synapses(self):
+        """
+        Checks if the internal projections or the synapse models of the
+        network may be plastic. Synapse models with parameters beyond those
+        of ``static_synapse`` are taken to be plastic.
+
+        :returns: `True` if there may be plastic synapses
+        """
+        static_keys = set(nest.GetDefaults('static_synapse'))
+        models = set(model_name for _, model_name, _
+                     in self.network.syn_models)
+        models.update(conndict.get('synapse_model', 'static_synapse')
+                      for _, _, conndict in self.network.projections)
+        return any(set(nest.GetDefaults(model)) - static_keys
+                   for model in models)
+
+    def reset_network(self):
+        """
+        Resets the state of all nodes, the simulation time and the seeds of
+        the random number generators, keeping the nodes and connections, so
+        that simulations run as in a newly built network.
+        """
+        with self.timed('reset_network'):
+            nest.ResetNetwork()
+            nest.SetKernelStatus(dict(self.kernel_seeds, time=0.))
+
+    def restore_kernel_seeds(self):
+        """
+        Sets the seeds of the random number generators back to those the
+        kernel was reset with. This is done once the internal projections
+        are connected, as connecting them draws from the generators, and
+        restoring them from the connectome cache or keeping them does not.
+        Simulations then start from the same state of the generators however
+        the connections were made.
+        """
+        nest.SetKernelStatus(self.kernel_seeds)
+
+    def retire_device(self, nest_device):
+        """
+        Deactivates a device, as nodes cannot be removed from NEST without
+        resetting the kernel.
+
+        :param nest_device: GIDs of the device
+        """
+        nest.SetStatus(nest_device, {'start': 0., 'stop': 0.})
+        self.retired_devices.append(nest_device)
+
     def connect_internal_projections(self):
         """
         Connects all internal projections, as specified in network
-        specifications.
+        specifications. If the connectome cache is enabled, the connections
+        are restored from the cache if possible, and otherwise stored in it.
+        Either way, the seeds of the random number generators are restored
+        afterwards.
         """
+        if self.connectome_cache is not None:
+            key = self.get_connectome_key()
+            connectome = self.connectome_cache.load(key)
+            if connectome is not None:
+                self.print("Restoring internal projections from cache...")
+                with self.timed('restore_connectome',
+                                connections=len(connectome['source'])):
+                    self.restore_connectome(connectome)
+                self.restore_kernel_seeds()
+                return
+
         self.print("Connecting internal projections...")
-        internal_projections = self.networkSpecs['projections']
-        for proj in internal_projections:
-            pre = proj[0]
-            post = proj[1]
-            conndict = self.floatify_dictionary(proj[2])
-            tp.ConnectLayers(self.layers[pre], self.layers[post], conndict)
+        internal_projections = self.network.projections
+        for pre, post, conndict in internal_projections:
+            num_connections = nest.GetKernelStatus('num_connections')
+            with self.timed('connect_layers', pre=pre, post=post) as record:
+                tp.ConnectLayers(self.layers[pre], self.layers[post],
+                                 conndict)
+            record['connections'] = (nest.GetKernelStatus('num_connections') -
+                                     num_connections)
             self.print("Connected {} and {}".format(pre, post))
 
-    def floatify_dictionary(self, dict_to_floatify):
+        if self.connectome_cache is not None:
+            with self.timed('save_connectome'):
+                self.connectome_cache.save(key, self.get_connectome())
+        self.restore_kernel_seeds()
+
+    def get_connectome_key(self):
         """
-        Function that goes through a (possibly nested) dictionary and
-        floatifies integers.
+        Gets the key of the connectome in the connectome cache. The
+        connections made depend on the network specifications, the seeds of
+        the random number generators, the number of virtual processes and the
+        MPI rank. The format of the cached connectome is also part of the
+        key.
 
-        :param dict_to_floatify: dictionary to go through
-        :returns: dictionary where integers are floats
+        :returns: key of the connectome
+        """
+        status = nest.GetKernelStatus()
+        # Under MPI, each rank only has its own connections.
+        key = json.dumps([CONNECTOME_FORMAT,
+                          self.spec_hash,
+                          status['grng_seed'],
+                          list(status['rng_seeds']),
+                          status['total_num_virtual_procs'],
+                          self.rank])
+        return hashlib.sha1(key).hexdigest()
+
+    def get_connectome(self):
+        """
+        Gets all connections in the network. Weights, delays, receptors and
+        synapse models are all ``ConnectLayers`` can set for each connection,
+        so the connectome describes the connections fully before anything is
+        simulated.
+
+        :returns: dictionary of arrays of sources, targets, weights, delays,
+            receptors and synapse models of the connections
+        """
+        connections = nest.GetConnections()
+        if not connections:
+            return {'source': np.array([], dtype=np.int64),
+                    'target': np.array([], dtype=np.int64),
+                    'weight': np.array([]),
+                    'delay': np.array([]),
+                    'receptor': np.array([], dtype=np.int64),
+                    'synapse_model': np.array([], dtype=str)}
+        status = nest.GetStatus(connections, ['source', 'target', 'weight',
+                                              'delay', 'receptor',
+                                              'synapse_model'])
+        sources, targets, weights, delays, receptors, models = zip(*status)
+        return {'source': np.array(sources, dtype=np.int64),
+                'target': np.array(targets, dtype=np.int64),
+                'weight': np.array(weights, dtype=np.float64),
+                'delay': np.array(delays, dtype=np.float64),
+                'receptor': np.array(receptors, dtype=np.int64),
+                'synapse_model': np.array([str(m) for m in models])}
+
+    def restore_connectome(self, connectome):
         """
-        for d in dict_to_floatify:
-            if isinstance(dict_to_floatify[d], dict):
-                self.floatify_dictionary(dict_to_floatify[d])
-            elif isinstance(dict_to_floatify[d], numbers.Number):
-                dict_to_floatify[d] = float(dict_to_floatify[d])
-        return dict_to_floatify
+        Makes the connections of a connectome, one bulk connection call per
+        synapse model.
+
+        :param connectome: Dictionary of arrays, as returned by
+                           :meth:`get_connectome`
+        """
+        models = connectome['synapse_model']
+        for model in np.unique(models):
+            mask = models == model
+            nest.Connect(connectome['source'][mask].tolist(),
+                         connectome['target'][mask].tolist(),
+                         {'rule': 'one_to_one'},
+                         {'model': str(model),
+                          'weight': connectome['weight'][mask],
+                          'delay': connectome['delay'][mask],
+                          'receptor_type': connectome['receptor'][mask]})
 
     def connect_to_devices(self):
         """
         Makes connections from selections specified by the user.
         """
         self.reset_saved_network()
-        if self.device_projections is None:
+        device_projections = (self.device_projections
+                              if self.device_projections is not None else {})
+
+        # Devices from the last connect that have been removed or changed.
+        for device_name in list(self.devices):
+            projection, nest_device = self.devices[device_name]
+            if device_projections.get(device_name) != projection:
+                self.retire_device(nest_device)
+                del self.devices[device_name]
+
+        if not device_projections:
             return
 
         self.print("Connecting to devices...")
         params_to_floatify = ['rate', 'amplitude', 'frequency']
         reverse_connection = ['voltmeter', 'poisson_generator', 'ac_generator']
 
-        for device_name in self.device_projections:
-            model = self.device_projections[device_name]['specs']['model']
-            params = self.device_projections[device_name]['specs']['params']
+        for device_name in device_projections:
+            model = device_projections[device_name]['specs']['model']
+            params = device_projections[device_name]['specs']['params']
 
             if model == 'LFP':
-                self.connect_to_lfp()
-                self.connect_to_poisson()
+                with self.timed('connect_lfp'):
+                    self.connect_to_lfp()
+                    self.connect_to_poisson()
+                self.lfp_connected = True
                 continue
 
-            # floatify params
-            for key in params:
-                if key in params_to_floatify:
-                    params[key] = float(params[key])
-            nest_device = nest.Create(model, 1, params)
+            if device_name in self.devices:
+                # Unchanged device, still connected.
+                nest_device = self.devices[device_name][1]
+                if 'record_to' in nest.GetStatus(nest_device)[0]:
+                    nest.SetStatus(nest_device, 'n_events', 0)
+                    self.rec_devices.append([device_name, nest_device])
+                continue
+
+            # floatify params, in a copy, so the projection is kept as it was
+            # received for finding unchanged devices in the next connect.
+            nest_params = {key: (float(value) if key in params_to_floatify
+                                 else value)
+                           for key, value in params.items()}
+            with self.timed('create_device', device=device_name):
+                nest_device = nest.Create(model, 1, nest_params)
 
             # If it is a recording device, add it to the list
             if 'record_to' in nest.GetStatus(nest_device)[0]:
                 self.rec_devices.append([device_name, nest_device])
+            self.devices[device_name] = [device_projections[device_name],
+                                         nest_device]
 
-            connectees = self.device_projections[device_name]['connectees']
+            connectees = device_projections[device_name]['connectees']
             for selection in connectees:
-                nest_neurons = self.get_gids(selection)
+                with self.timed('get_gids', device=device_name) as record:
+                    # NEST 2 takes GIDs as lists, not arrays.
+                    nest_neurons = self.get_selected_gids(selection).tolist()
+                record['gids'] = len(nest_neurons)
 
                 synapse_model = (selection['synModel']
                                  if not [device_name, nest_device]
@@ -449,12 +1339,14 @@ class NESTClient(object):
                     synapse_model = 'static_synapse'
                 elif model in reverse_connection:
                     self.print("Connecting {} to {}".format(model, "neurons"))
-                    nest.Connect(nest_device, nest_neurons,
-                                 syn_spec=synapse_model)
+                    with self.timed('connect_device', device=device_name):
+                        nest.Connect(nest_device, nest_neurons,
+                                     syn_spec=synapse_model)
                 else:
                     self.print("Connecting {} to {}".format("neurons", model))
-                    nest.Connect(nest_neurons, nest_device,
-                                 syn_spec=synapse_model)
+                    with self.timed('connect_device', device=device_name):
+                        nest.Connect(nest_neurons, nest_device,
+                                     syn_spec=synapse_model)
 
     def connect_to_poisson(self):
         net_dict = {'bg_rate': 8.,
@@ -561,7 +1453,8 @@ class NESTClient(object):
 
         print('Connecting to LFP model...')
         connectees = self.device_projections['LFP']['connectees']
-        selected_neurons = [self.get_gids(s) for s in connectees]
+        selected_neurons = [self.get_selected_gids(s).tolist()
+                            for s in connectees]
         for ch, lfp_det in enumerate(lfp_detectors):
             nest.Connect((multimeters[ch],), lfp_det)
             for neurons in selected_neurons:
@@ -573,295 +1466,229 @@ class NESTClient(object):
         Handles get number of connections. Gets number of connections from
         NEST, then sends them to NESTInterface.
         """
+        num_connections = self.get_num_connections()
+        if self.rank != 0:
+            return
         msg = fm.float_message()
-        msg.value = nest.GetKernelStatus()['num_connections']
+        msg.value = num_connections
         self.slot_out_nconnections.send(msg.SerializeToString())
         self.print('Sent Nconnections: {}'.format(msg.value))
         self.send_complete_signal()
 
-    def make_mask(self, lower_left, upper_right, mask_type, azimuth_angle,
-                  polar_angle, cntr):
-        """
-        Makes a mask from the specifications.
-
-        :param lower_left: Coordinates for lower left of the selection.
-        :param upper_right: Coordinates for upper right of the selection.
-        :param mask_type: Shape of the mask. Either ``rectangle`` or
-                          ``ellipse``.
-        :param azimuth_angle: Rotation angle in degrees from x-axis.
-        :param polar_angle: Rotation angle in degrees from z-axis.
-        :param cntr: Coordinates for the centre of the layer.
-        :returns: A NEST ``Mask`` object.
-        """
-
-        if mask_type == 'rectangular':
-            spec = {'lower_left': [lower_left[0] - cntr[0],
-                                   lower_left[1] - cntr[1]],
-                    'upper_right': [upper_right[0] - cntr[0],
-                                    upper_right[1] - cntr[1]],
-                    'azimuth_angle': azimuth_angle
-                    }
-        elif mask_type == 'elliptical':
-            # Calculate centre of ellipse
-            xpos = (upper_right[0] + lower_left[0]) / 2.0
-            ypos = (upper_right[1] + lower_left[1]) / 2.0
-            # Find major and minor axis
-            x_side = upper_right[0] - lower_left[0]
-            y_side = upper_right[1] - lower_left[1]
-            if x_side >= y_side:
-                major = x_side
-                minor = y_side
-            else:
-                major = y_side
-                minor = x_side
-            spec = {'major_axis': major, 'minor_axis': minor,
-                    'anchor': [xpos - cntr[0], ypos - cntr[1]],
-                    'azimuth_angle': azimuth_angle
-                    }
-        elif mask_type == 'box':
-            spec = {'lower_left': [lower_left[0] - cntr[0],
-                                   lower_left[1] - cntr[1],
-                                   lower_left[2]],
-                    'upper_right': [upper_right[0] - cntr[0],
-                                    upper_right[1] - cntr[1],
-                                    upper_right[2]],
-                    'azimuth_angle': azimuth_angle,
-                    'polar_angle': polar_angle
-                    }
-        elif mask_type == 'ellipsoidal':
-            # Calculate centre of ellipse
-            xpos = (upper_right[0] + lower_left[0]) / 2.0
-            ypos = (upper_right[1] + lower_left[1]) / 2.0
-            zpos = (upper_right[2] + lower_left[2]) / 2.0
-            # Find major and minor axis
-            x_side = upper_right[0] - lower_left[0]
-            y_side = upper_right[1] - lower_left[1]
-            z_side = upper_right[2] - lower_left[2]
-            if x_side >= y_side:
-                major = x_side
-                minor = y_side
-            else:
-                major = y_side
-                minor = x_side
-            spec = {'major_axis': major, 'minor_axis': minor,
-                    'polar_axis': z_side,
-                    'anchor': [xpos - cntr[0], ypos - cntr[1], zpos],
-                    'azimuth_angle': azimuth_angle,
-                    'polar_angle': polar_angle}
-        else:
-            raise ValueError('Invalid mask type: %s' % mask_type)
-
-        mask = tp.CreateMask(mask_type, spec)
+    def get_num_connections(self):
+        """
+        Gets the number of connections from NEST. Under MPI, the connections
+        of all ranks are summed.
 
-        return mask
+        :returns: number of connections
+        """
+        num_connections = nest.GetKernelStatus('num_connections')
+        if self.comm is not None:
+            num_connections = self.comm.allreduce(num_connections,
+                                                  op=MPI.SUM)
+        return num_connections
 
     def handle_get_gids(self, selection):
         self.print("Get gids")
 
         selection_dict = json.loads(selection)
-        gids = self.get_gids(selection_dict)
+        self.ensure_network_built()
+        gids = self.get_selected_gids(selection_dict)
 
-        self.print("GID positions:")
-        self.print(tp.GetPosition(gids))
-        self.print(gids)
+        if self.rank == 0:
+            self.print("GID positions:")
+            self.print(self.get_gid_positions(gids))
+            self.print(gids)
         self.send_complete_signal()
         return gids
 
-    def get_gids(self, selection_dict):
+    def get_gid_positions(self, gids):
         """
-        Gets a list of the selected GIDs.
+        Gets the positions of GIDs from the network specifications. Unlike
+        ``tp.GetPosition``, this also works for nodes on other MPI ranks.
 
-        :param selection_dict: Dictionary containing specifications of the
-                               selected areas.
-        :returns: List of the selected GIDs
-        """
-        layer_names = selection_dict['name']
-        selection = selection_dict['selection']
-        mask_type = selection_dict['maskShape']
-        neuron_type = selection_dict['neuronType']
-        azimuth_angle = float(selection_dict['azimuthAngle']) * 180 / math.pi
-        if 'polarAngle' in selection_dict:
-            polar_angle = float(selection_dict['polarAngle']) * 180 / math.pi
-        else:
-            polar_angle = 0.0
+        :param gids: Array of GIDs of neurons in the layers
+        :returns: array with one row of coordinates per GID
+        """
+        positions = None
+        for layer in self.network.layers:
+            if positions is None:
+                positions = np.empty((len(gids), layer.positions.shape[1]))
+            first_gid = self.layers[layer.name][0] + 1
+            n_positions = len(layer.positions)
+            in_layer = ((gids >= first_gid) &
+                        (gids < first_gid + n_positions * layer.n_elements))
+            positions[in_layer] = layer.positions[
+                (gids[in_layer] - first_gid) % n_positions]
+        return positions
+
+    def handle_get_gids_batch(self, selections):
+        """
+        Handles getting the GIDs of several selections at once. Sends the
+        number of GIDs in each selection, and the lowest and highest of them,
+        to NESTInterface in one message.
 
-        ll = [selection['ll']['x'], selection['ll']['y'], selection['ll']['z']]
-        ur = [selection['ur']['x'], selection['ur']['y'], selection['ur']['z']]
+        :param selections: List of selections, in JSON format
+        :returns: list of dictionaries with the count, lowest and highest GID
+            of each selection
+        """
+        self.awaiting_selections = self.rank == 0
+        selection_dicts = json.loads(selections)
+        self.print("Get gids of {} selections".format(len(selection_dicts)))
+        self.ensure_network_built()
+        if self.rank != 0:
+            return
+        results = []
+        for selection_dict in selection_dicts:
+            gids = self.get_selected_gids(selection_dict)
+            results.append({'count': len(gids),
+                            'min_gid': int(gids.min()) if len(gids) else None,
+                            'max_gid': int(gids.max()) if len(gids) else None})
+
+        self.send_selections(results)
+        self.awaiting_selections = False
+        self.send_complete_signal()
+        return results
 
-        # TODO: There must be a better way to do this. Also, centre in origo is
-        # not always correct. Also, does SelectNodesByMask really need to be
-        # sent cntr? Could it work if we said that it start in origo at c++
-        # level? What happens if layer is outside origo?
-        if (ll[2] == ur[2]):
-            cntr = [0.0, 0.0]
-        else:
-            cntr = [0.0, 0.0, 0.0]
-        mask = self.make_mask(ll, ur, mask_type,
-                              azimuth_angle, polar_angle, cntr)
+    def send_selections(self, reply):
+        """
+        Sends the reply to a request for the GIDs of several selections to
+        NESTInterface.
 
-        collected_gids = []
-        # TODO: Think we might be able to use only one of these for-loops, the
-        # last one. And then check if layer['name'] is in layer_names.
-        # In case of a 3D layer, we have to go through all the layer names in
-        # the selection_dict, because we only have one dict for the selection,
-        # but the area might encompass several layers.
-        for name in layer_names:
-            gids = tp.SelectNodesByMask(self.layers[name],
-                                        cntr, mask)
+        :param reply: List of the results of each selection, or a dictionary
+                      with an ``error`` if getting them failed
+        """
+        msg = sm.string_message()
+        msg.value = json.dumps(reply)
+        self.slot_out_selections.send(msg.SerializeToString())
 
-            # If we have chosen neuron_type All, we return all the GIDs.
-            if neuron_type == "All":
-                collected_gids += gids
-                continue
+    def get_selected_gids(self, selection_dict):
+        """
+        Gets the selected GIDs, from the selection cache if the same
+        selection has been made before in the current build of the network.
+        The returned GIDs are shared with the cache, and must not be changed.
 
-            # If we have chosen a specific neuron_type, we have to find the
-            # correct GIDs. To do this, we have to go through all the layers
-            # and compare to the type we have chosen.
-            for layer in self.networkSpecs['layers']:
-                if name == layer['name']:
-                    # All the elements in the selected layer
-                    models = layer['elements']
-
-                    # If neuron_type is in models, the layer contains the
-                    # chosen neuron_type, and we must find the correct GIDs.
-                    if neuron_type in models:
-                        # If models is not a list, the layer contains only one
-                        # element type, we have chosen this type and the found
-                        # GIDs are the GIDs of the chosen element type.
-                        if not isinstance(models, list):
-                            collected_gids += gids
-                            continue
-
-                        # If models is a list, we need to find how many
-                        # positions we have chosen in the mask, how many nodes
-                        # the neuron_type have at each position and how many
-                        # nodes there are before the neuron_type. That is, we
-                        # need to find the indices for the neuron_type in the
-                        # GID list found above.
-                        totalNoOfEl = (
-                            selection_dict['noOfNeuronTypesInLayer'][name])
-                        numberOfPositions = len(gids) / totalNoOfEl
-
-                        start_idx, end_idx = (
-                            self.getIndicesOfNeuronType(neuron_type, models,
-                                                        numberOfPositions))
-                        sorted_gids = sorted(gids)
-                        collected_gids += sorted_gids[start_idx:end_idx]
-
-        return collected_gids
-
-    def getIndicesOfNeuronType(self, neuron_type, models, numberOfPositions):
-        """
-        Given a neuron type and number of selected neuron positions, finds the
-        start and end indices in the list of selected neurons.
-
-        :param neuron_type: type of neurons to find
-        :param models: list of neuron models, on the form
-            ``['L23pyr', 2, 'L23in', 1]`` or ``['Relay', 'Inter']``
-        :param numberOfPositions: number of selected neuron positions
-        """
-
-        # We count number of elements. So Relay will set counter to 1, while
-        # L23pyr will set counter to 2.
-        counter = 0
-        list_counter = 0
-        start_index = 0
-        end_index = 0
-        for mod in models:
-            # If mod is a string, we add the element, unless mod is
-            # the neuron type, in which we need to find the indices.
-            if isinstance(mod, str):
-                if mod == neuron_type:
-                    start_index = counter * numberOfPositions
-
-                    model_is_string = isinstance(models[list_counter + 1], str)
-                    if (list_counter + 1 == len(models) or model_is_string):
-                        end_index = (counter + 1) * numberOfPositions
-                    else:
-                        end_index = ((counter + models[list_counter + 1]) *
-                                     numberOfPositions)
-                    break
-                # Adding element
-                counter += 1
-            else:
-                # If mod is not a string, we have a number telling us how many
-                # elements of the last type there is, so we add the number and
-                # subtract the element count from above.
-                counter += mod - 1
-            list_counter += 1
-
-        return int(start_index), int(end_index)
+        :param selection_dict: Dictionary containing specifications of the
+                               selected areas.
+        :returns: Array of the selected GIDs
+        """
+        key = (self.build_id, get_selection_key(selection_dict))
+        gids = self.selection_cache.get(key)
+        if gids is None:
+            gids = self.get_gids(selection_dict)
+            self.selection_cache.put(key, gids)
+        return gids
+
+    def get_gids(self, selection_dict):
+        """
+        Gets an array of the selected GIDs. Like the connectome, it is
+        converted to a list before it is passed to ``nest.Connect``.
+
+        :param selection_dict: Dictionary containing specifications of the
+                               selected areas.
+        :returns: Array of the selected GIDs
+        """
+        collected_gids = []
+        for layer, (start_idx, end_idx), positions in (
+                self.selector.select(selection_dict)):
+            # The positions inside the mask are found from the positions in
+            # the network specifications, instead of asking NEST. NEST makes
+            # the nodes of a layer one element at a time, each with a node
+            # at every position, so the GIDs follow from the indices of the
+            # positions.
+            first_gid = self.layers[layer.name][0] + 1
+            elements = np.arange(start_idx, end_idx)[:, np.newaxis]
+            gids = first_gid + elements * len(layer.positions) + positions
+            collected_gids.append(gids.ravel())
+
+        if not collected_gids:
+            return np.array([], dtype=np.int64)
+        return np.concatenate(collected_gids)
 
     def get_device_results(self):
         """
-        Gets results from devices.
+        Gets results from devices. The events of each recording device are
+        kept as columns, arrays of senders, times and, for voltmeters,
+        membrane potentials, so every event is kept, also when a sender
+        spikes more than once in a step.
 
         :returns: if there are new results from the devices, returns a
             dictionary with these, else returns `None`
         """
 
         results = {}
-        # TODO: Set up on the fly
-        recording_events = {'spike_det': {'senders': [], 'times': []},
-                            'rec_dev': {'times': [], 'V_m': []},
-                            'lfp_det': {str(i): {'lfp': []}
-                                        for i in range(16)}}
-        recording_events['lfp_det']['times'] = []
-
-        time_array = []
-        vm_array = []
-
+        spike_senders = []
+        spike_times = []
+        lfp = [[] for _ in range(16)]
+        lfp_times = []
+
+        vm_times = []
+        vm_senders = []
+        vm_values = []
+
+        # The events of all recording devices are got with one call, and the
+        # devices with events are reset with one call.
+        device_gids = [gid for _, device_gid in self.rec_devices
+                       for gid in device_gid]
+        statuses = (nest.GetStatus(device_gids, ('n_events', 'events'))
+                    if device_gids else [])
+        reset_gids = []
+        start = 0
         for device_name, device_gid in self.rec_devices:
-            status = nest.GetStatus(device_gid)[0]
-
-            if status['n_events'] > 0:
-                events = {}
-                device_events = status['events']
-
-                # TODO numpy in json?
+            device_statuses = statuses[start:start + len(device_gid)]
+            start += len(device_gid)
+            n_events, device_events = device_statuses[0]
+
+            if n_events > 0:
+                senders = np.asarray(device_events['senders'], dtype=np.int64)
+                times = np.asarray(device_events['times'], dtype=np.float64)
+                events = {'senders': senders, 'times': times}
                 if 'voltmeter' in device_name:
-                    for e in range(status['n_events']):
-                        events[str(device_events['senders'][e])] = [
-                            device_events['times'][e],
-                            round(device_events['V_m'][e])]
-                else:
-                    for e in range(status['n_events']):
-                        events[str(device_events['senders'][e])] = [
-                            device_events['times'][e]]
+                    V_m = np.asarray(device_events['V_m'], dtype=np.float64)
+                    events['V_m'] = np.round(V_m)
                 results[device_name] = events
 
                 # For plotting:
                 # (All should just be one dictionary eventually...)
                 if 'spike_detector' in device_name:
-                    recording_events['spike_det']['senders'] += (
-                        [float(y) for y in device_events['senders']])
-                    recording_events['spike_det']['times'] += (
-                        [float(x) for x in device_events['times']])
+                    spike_senders.append(senders)
+                    spike_times.append(times)
                 elif 'voltmeter' in device_name:
-                    vm_count = -1
-                    for count, t in enumerate(device_events['times']):
-                        if t not in time_array:
-                            time_array.append(t)
-                            vm_array.append([])
-                            vm_count += 1
-                        vm_array[vm_count].append(device_events['V_m'][count])
-                    recording_events['rec_dev']['times'] += time_array
-                    recording_events['rec_dev']['V_m'] += vm_array
+                    vm_times.append(times)
+                    vm_senders.append(senders)
+                    vm_values.append(V_m)
                 elif 'lfp_multimeters' in device_name:
-                    for ch in range(len(device_gid)):
-                        # device_gid is a list of GIDs
-                        mm_status = nest.GetStatus((device_gid[ch],))
-                        events = mm_status[0]['events']
-                        recording_events['lfp_det'][str(ch)]['lfp'] += [
-                            float(l) for l in events['lfp']]
-                    recording_events['lfp_det']['times'] += [
-                        float(t) for t in events['times']]
+                    # device_gid is a list of GIDs, one for each channel
+                    for ch, (_, mm_events) in enumerate(device_statuses):
+                        lfp[ch].append(np.asarray(mm_events['lfp'],
+                                                  dtype=np.float64))
+                    lfp_times.append(np.asarray(mm_events['times'],
+                                                dtype=np.float64))
+
+                reset_gids.extend(device_gid)
 
-                nest.SetStatus(device_gid, 'n_events', 0)  # reset the device
+        if reset_gids:
+            nest.SetStatus(reset_gids, 'n_events', 0)  # reset the devices
 
         self.last_results = results
         if results:
-            recording_events['time'] = nest.GetKernelStatus('time')
+            # Membrane potentials as a matrix, with a row for each time and
+            # a column for each sender.
+            vm_times, vm_senders, vm_matrix = group_by_time(
+                concatenate_arrays(vm_times),
+                concatenate_arrays(vm_senders, np.int64),
+                concatenate_arrays(vm_values))
+            lfp_det = {str(ch): {'lfp': concatenate_arrays(lfp[ch])}
+                       for ch in range(16)}
+            lfp_det['times'] = concatenate_arrays(lfp_times)
+            recording_events = {
+                'spike_det': {
+                    'senders': concatenate_arrays(spike_senders, np.int64),
+                    'times': concatenate_arrays(spike_times)},
+                'rec_dev': {'times': vm_times, 'senders': vm_senders,
+                            'V_m': vm_matrix},
+                'lfp_det': lfp_det,
+                'time': nest.GetKernelStatus('time')}
             return {"stream_results": results,
                     "plot_results": recording_events}
         else:
@@ -870,5 +1697,9 @@ class NESTClient(object):
 
 if __name__ == '__main__':
     user_id = sys.argv[1]
+    port = (int(sys.argv[2]) if len(sys.argv) > 2 and sys.argv[2] != '-s'
+            else None)
     # silent = sys.argv[1] == '-s' if len(sys.argv) > 1 else False
-    client = NESTClient(user_id, silent=False)
+    client = NESTClient(user_id, silent=False, port=port)
+    if client.rank != 0:
+        client.follow_commands()
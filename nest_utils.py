@@ -4,13 +4,20 @@ import __builtin__  # for Python 3: builtins as __builtin__
 import os
 import sys
 import threading
+import multiprocessing
 import time
+import json
 import random
+import hashlib
 import atexit
 import contextlib
+import collections
+import gevent
+import gevent.event
 import nett_python as nett
 import float_message_pb2 as fm
 import string_message_pb2 as sm
+import network_specs
 
 nett = reload(nett)  # In case nett has been changed by the testsuite.
 nett.initialize('tcp://127.0.0.1:2001')
@@ -25,6 +32,21 @@ if os.name == 'posix' and sys.version_info[0] < 3:
 else:
     import subprocess as sp
 
+# Number of MPI processes to run each NEST client with. With more than one,
+# the client is started with mpirun.
+MPI_PROCESSES = int(os.environ.get('NEST_MPI_PROCESSES', 1))
+# Prefix of the results the NEST client sends instead of device results when
+# getting or sending them failed. Must match ERROR_RESULT_PREFIX in
+# nest_client.
+ERROR_RESULT_PREFIX = 'error '
+# Ports of the NEST clients of users are picked from 8001 to 9000, from the
+# user ID. Pooled clients, which have negative IDs, get ports counting up
+# from POOL_PORT_BASE instead, so they do not collide with the clients of
+# users, nor, until the range of POOL_PORT_COUNT ports wraps, with each other.
+USER_PORT_BASE = 8000
+POOL_PORT_BASE = 9001
+POOL_PORT_COUNT = 1000
+
 
 def print(*args, **kwargs):
     """
@@ -36,6 +58,47 @@ def print(*args, **kwargs):
     return __builtin__.print(*args, **kwargs)
 
 
+def make_async_watcher(loop):
+    """
+    Makes a watcher that wakes up the gevent loop when sent from any thread.
+
+    :param loop: The gevent loop to wake up
+    :returns: an unstarted async watcher
+    """
+    # gevent 1.3 renamed loop.async to loop.async_, as async is a keyword in
+    # newer versions of Python.
+    if hasattr(loop, 'async_'):
+        return loop.async_()
+    return getattr(loop, 'async')()
+
+
+def get_available_cpus():
+    """
+    Gets the CPUs this process may run on.
+
+    :returns: list of CPU IDs
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return range(multiprocessing.cpu_count())
+
+
+def set_process_affinity(pid, cpus):
+    """
+    Pins all threads of a process to a set of CPUs. Does nothing, apart from
+    printing a warning, where this is not supported.
+
+    :param pid: Process ID
+    :param cpus: List of CPU IDs
+    """
+    cpu_list = ','.join(str(cpu) for cpu in cpus)
+    try:
+        sp.check_output(['taskset', '-a', '-p', '-c', cpu_list, str(pid)])
+    except (OSError, sp.CalledProcessError) as exception:
+        print('WARNING: Could not set CPU affinity of process {}: {}'.format(
+            pid, exception))
+
+
 class observe_slot(threading.Thread):
     """
     A listener for messages from the NESTClient. Each listener spawns its own
@@ -79,51 +142,105 @@ class observe_slot(threading.Thread):
             self.last_message = self.msg
 
 
+def get_client_port(client_id):
+    """
+    Gets the port a NEST client communicates on.
+
+    :param client_id: ID of the client, negative for pooled clients
+    :returns: port number
+    """
+    if client_id < 0:
+        return POOL_PORT_BASE + (-client_id - 1) % POOL_PORT_COUNT
+    # Python 2 seeds with the absolute value of an integer, so only user IDs,
+    # which are positive, are used as seeds.
+    return USER_PORT_BASE + random.Random(client_id).randint(1, 1000)
+
+
+def hash_network_specs(networkSpecs):
+    """
+    Hashes network specifications, so that unchanged networks can be
+    recognised without comparing the specifications themselves.
+
+    :param networkSpecs: Network specifications, in JSON format
+    :returns: hex digest of the specifications
+    """
+    if isinstance(networkSpecs, unicode):
+        networkSpecs = networkSpecs.encode('utf-8')
+    return hashlib.sha1(networkSpecs).hexdigest()
+
+
 class NESTInterface(object):
     """
     For interacting with the NESTClient.
 
     :param networkSpecs: Dictionary of network specifications, including
-                         synapse specifications and projections between layers
+                         synapse specifications and projections between layers.
+                         If `None`, the NEST client is started, but no network
+                         is made until :meth:`assign` is called.
     :param device_projections: Optional list of projections between layers and
                                devices
+    :param client_id: Optional ID used for communicating with the NEST client.
+                      Defaults to the user ID.
+    :param mpi_processes: Optional number of MPI processes to run the NEST
+                          client with. Defaults to ``MPI_PROCESSES``.
     """
 
     def __init__(self, networkSpecs,
                  user_id,
                  device_projections='[]',
                  silent=False,
-                 socketio=None):
+                 socketio=None,
+                 client_id=None,
+                 mpi_processes=None):
         self.networkSpecs = networkSpecs
+        self.spec_hash = None
+        self.selector = None
+        self.selector_specs = None
         self.device_projections = device_projections
         self.user_id = user_id
+        self.client_id = user_id if client_id is None else client_id
+        self.mpi_processes = (MPI_PROCESSES if mpi_processes is None
+                              else mpi_processes)
         self.device_results = None
+        self.timings = {}
+        # Results are received by an observer thread, and handed over to
+        # greenlets waiting for them through an async watcher.
+        self.received_results = collections.deque()
+        self.pending_results = collections.deque()
+        # Number of results still to come from steps that are given up on.
+        self.n_dropped_results = 0
+        self.results_watcher = None
         self.silent = silent
         self.socketio = socketio
 
         atexit.register(self.terminate_nest_client)
 
         self.slot_out_data = nett.slot_out_string_message(
-            'data_{}'.format(self.user_id))
+            'data_{}'.format(self.client_id))
 
         self.slot_in_complete = nett.slot_in_float_message()
         self.slot_in_nconnections = nett.slot_in_float_message()
         # self.slot_in_gids = nett.slot_in_string_message()
         self.slot_in_device_results = nett.slot_in_string_message()
         self.slot_in_status_message = nett.slot_in_string_message()
+        self.slot_in_timings = nett.slot_in_string_message()
+        self.slot_in_selections = nett.slot_in_string_message()
 
-        random.seed(self.user_id)
-        port_increment = random.randint(1, 1000)
-        client_address = 'tcp://127.0.0.1:{}'.format(8000 + port_increment)
-        self.slot_in_complete.connect(client_address,
-                                      'task_complete_{}'.format(self.user_id))
+        self.port = get_client_port(self.client_id)
+        client_address = 'tcp://127.0.0.1:{}'.format(self.port)
+        self.slot_in_complete.connect(
+            client_address, 'task_complete_{}'.format(self.client_id))
         self.slot_in_nconnections.connect(
-            client_address, 'nconnections_{}'.format(self.user_id))
+            client_address, 'nconnections_{}'.format(self.client_id))
         # self.slot_in_gids.connect(client_address, 'GIDs')
         self.slot_in_device_results.connect(
-            client_address, 'device_results_{}'.format(self.user_id))
+            client_address, 'device_results_{}'.format(self.client_id))
         self.slot_in_status_message.connect(
-            client_address, 'status_message_{}'.format(self.user_id))
+            client_address, 'status_message_{}'.format(self.client_id))
+        self.slot_in_timings.connect(
+            client_address, 'timings_{}'.format(self.client_id))
+        self.slot_in_selections.connect(
+            client_address, 'selections_{}'.format(self.client_id))
 
         self.observe_slot_ready = observe_slot(self.slot_in_complete,
                                                fm.float_message(),
@@ -139,22 +256,81 @@ class NESTInterface(object):
             self.slot_in_status_message,
             sm.string_message(),
             self.handle_status_message)
+        self.observe_slot_timings = observe_slot(
+            self.slot_in_timings,
+            sm.string_message(),
+            self.handle_timings)
+        self.observe_slot_selections = observe_slot(
+            self.slot_in_selections,
+            sm.string_message(),
+            self.handle_selections)
 
         self.observe_slot_ready.start()
         self.observe_slot_nconnections.start()
         self.observe_slot_device_results.start()
         self.observe_slot_status_message.start()
+        self.observe_slot_timings.start()
+        self.observe_slot_selections.start()
 
         self.event = threading.Event()
+        # Whether the client reported that the last command failed.
+        self.command_failed = False
+        self.selections = None
+        self.selections_error = None
+        self.selections_event = threading.Event()
+        self.cpus = []
+        self.num_threads = 1
+        # Number of threads NEST actually runs with, as reported by the client
+        # after each command. The number of threads set only takes effect the
+        # next time the client resets its kernel.
+        self.kernel_threads = 1
 
+        start_time = time.time()
         with self.wait_for_client(10):
             self.start_nest_client()
+        self.spawn_time = time.time() - start_time
+
+        if self.networkSpecs is not None:
+            self.setup_network()
+
+    def assign(self, user_id, networkSpecs, device_projections='[]'):
+        """
+        Assigns a NEST client to a user, and makes the network. Used both for
+        idle clients and for remaking the network of a user's own client.
+
+        :param user_id: ID of the user the client is assigned to
+        :param networkSpecs: Dictionary of network specifications
+        :param device_projections: Optional list of projections between layers
+                                   and devices
+        """
+        self.user_id = user_id
+        self.networkSpecs = networkSpecs
+        self.device_projections = device_projections
+        self.timings = {}
+        self.setup_network()
+
+    def setup_network(self):
+        """
+        Resets the kernel of the NEST client and sends it the network
+        specifications and device projections. The specifications are passed
+        on without being decoded, and are validated by the client. The hash
+        of the specifications is only recorded once the client has accepted
+        them, so rejected specifications are not taken to be the current
+        network.
+
+        :raises ValueError: if the client could not make the network from the
+            specifications
+        """
+        self.spec_hash = None
         with self.wait_for_client():
             self.reset_kernel()
         if self.device_projections != '[]':
             self.send_device_projections()
         with self.wait_for_client():
             self.make_network()
+        if self.command_failed:
+            raise ValueError('The NEST client could not make the network')
+        self.spec_hash = hash_network_specs(self.networkSpecs)
 
     def print(self, *args, **kwargs):
         """
@@ -185,21 +361,79 @@ class NESTInterface(object):
     def start_nest_client(self):
         """
         Starting the NEST client in a separate process using the subprocess
-        module.
+        module. With more than one MPI process, the client is started with
+        mpirun.
         """
-        cmd = ['python', 'nest_client.py', str(self.user_id)]
+        cmd = ['python', 'nest_client.py', str(self.client_id),
+               str(self.port)]
+        if self.mpi_processes > 1:
+            cmd = ['mpirun', '-n', str(self.mpi_processes)] + cmd
         if self.silent:
             self.client = sp.Popen(cmd + ['-s'], stdout=sp.PIPE)
         else:
             self.client = sp.Popen(cmd)
         self.print('NEST client started')
 
+    def set_cpus(self, cpus):
+        """
+        Pins the NEST client process to a set of CPUs, and makes NEST use one
+        thread per CPU from the next time the kernel is reset. The client is
+        only sent the number of threads when it changes. Under MPI, the CPUs
+        are shared between the processes, and placing the processes is left
+        to mpirun.
+
+        :param cpus: List of CPU IDs
+        """
+        if cpus == self.cpus:
+            return
+        self.cpus = list(cpus)
+        if self.mpi_processes == 1:
+            set_process_affinity(self.client.pid, self.cpus)
+        num_threads = max(1, len(self.cpus) // self.mpi_processes)
+        if num_threads != self.num_threads:
+            self.num_threads = num_threads
+            # Not waiting for the client, as it may be busy with another task.
+            self.send_to_client('set_threads', str(self.num_threads))
+        self.print('Placed NEST client on CPU(s) {}'.format(self.cpus))
+
+    def unpin(self):
+        """
+        Lets the NEST client process run on all CPUs again, for when its
+        session is no longer placed, so it does not stay pinned to CPUs given
+        to other sessions. The number of threads is left as it is.
+        """
+        if not self.cpus:
+            return
+        self.cpus = []
+        if self.mpi_processes == 1:
+            set_process_affinity(self.client.pid, get_available_cpus())
+        self.print('Unpinned NEST client')
+
+    def get_num_cores(self):
+        """
+        Gets the number of cores the NEST client uses, from the number of
+        threads NEST runs with now, rather than the number set to take effect
+        at the next kernel reset.
+
+        :returns: number of threads times number of MPI processes
+        """
+        return self.kernel_threads * self.mpi_processes
+
     def terminate_nest_client(self):
         """
-        Terminates the NEST client subprocess.
+        Terminates the NEST client subprocess, if it is still running.
         """
-        self.client.terminate()
-        stdout, stderr = self.client.communicate()
+        if self.client.poll() is None:
+            self.client.terminate()
+            stdout, stderr = self.client.communicate()
+
+    def close(self):
+        """
+        Stops the observing threads and terminates the NEST client, for when
+        the client is given up on.
+        """
+        self.cease_threads()
+        self.terminate_nest_client()
 
     def cease_threads(self):
         """
@@ -209,9 +443,14 @@ class NESTInterface(object):
         threads_before_cease = len(threading.enumerate())
         threads = [self.observe_slot_ready, self.observe_slot_nconnections,
                    self.observe_slot_device_results,
-                   self.observe_slot_status_message]
+                   self.observe_slot_status_message,
+                   self.observe_slot_timings,
+                   self.observe_slot_selections]
         for thread in threads:
             thread.ceased = True
+        if self.results_watcher is not None:
+            self.results_watcher.stop()
+            self.results_watcher = None
         # The threads are blocking until they receive a message. Therefore we
         # make the client ping all slots so that all threads are terminated.
         self.send_to_client('ping')
@@ -232,12 +471,14 @@ class NESTInterface(object):
         :param msg: The nett type message received.
         """
         self.print('Received complete signal')
+        self.command_failed = msg.value == 0.
         self.event.set()
 
     def reset_complete_signal(self):
         """
         Resets the complete signal.
         """
+        self.command_failed = False
         self.event.clear()
 
     def wait_until_client_finishes(self, timeout=None):
@@ -299,6 +540,78 @@ class NESTInterface(object):
         with self.wait_for_client():
             self.send_to_client('get_gids', selection)
 
+    def get_gids_batch(self, selections, timeout=10):
+        """
+        Gets the GIDs of several selections, in one message to the client.
+
+        :param selections: List of dictionaries containing specifications of
+            the selected areas, in JSON format
+        :param timeout: Time in seconds to wait for the result
+        :returns: list of dictionaries with the number of GIDs in each
+            selection, and the lowest and highest of them
+        :raises RuntimeError: if the client failed to get the GIDs, or no
+            result was received within the timeout
+        """
+        self.print('Sending get GIDs of several selections')
+        self.selections = None
+        self.selections_error = None
+        self.selections_event.clear()
+        with self.wait_for_client():
+            self.send_to_client('get_gids_batch', selections)
+        if not self.selections_event.wait(timeout):
+            raise RuntimeError(
+                'No selections received in {} s'.format(timeout))
+        if self.selections_error is not None:
+            raise RuntimeError(self.selections_error)
+        return self.selections
+
+    def handle_selections(self, msg):
+        """
+        Handles receiving the GIDs of several selections from the client.
+
+        :param msg: Nett type message with the selections, in JSON format
+        """
+        if not msg.value:
+            return
+        reply = json.loads(msg.value)
+        if isinstance(reply, dict) and 'error' in reply:
+            self.selections_error = reply['error']
+        else:
+            self.selections = reply
+        self.selections_event.set()
+
+    def get_selector(self):
+        """
+        Gets a selector for the network, compiling and validating the network
+        specifications the first time it is needed after they have changed.
+        This does not involve the NEST client. The specifications are only
+        decoded here, so the server does not keep a decoded copy of networks
+        no selection has been previewed in.
+
+        :returns: a :class:`network_specs.LayerSelector`
+        """
+        if (self.selector is None or
+                self.selector_specs is not self.networkSpecs):
+            specs = network_specs.parse(self.networkSpecs)
+            network_specs.validate(specs)
+            self.selector = network_specs.LayerSelector(
+                network_specs.compile_specs(specs))
+            self.selector_specs = self.networkSpecs
+        return self.selector
+
+    def preview_selection(self, selection_dict):
+        """
+        Counts the neurons in a selection from the network specifications,
+        without involving the NEST client, so it is fast and can be done
+        while the client is busy.
+
+        :param selection_dict: Dictionary containing specifications of the
+            selected areas
+        :returns: dictionary of counts, see
+            :meth:`network_specs.LayerSelector.count`
+        """
+        return self.get_selector().count(selection_dict)
+
     def connect_all(self):
         """
         Connects both projections between layers and projections between layers
@@ -325,12 +638,36 @@ class NESTInterface(object):
 
     def simulate(self, t):
         """
-        Runs a simulation for a specified time.
+        Runs a simulation for a specified time. A time of -1 makes the client
+        clean up after the simulation.
+
+        Must be called from the greenlet that is going to wait for the
+        results.
 
         :param t: time to simulate
+        :returns: a ``gevent.event.AsyncResult`` which is set to the device
+            results of the simulation when they are received, or `None` if
+            cleaning up
         """
         self.device_results = None  # Clear device results
+        result = None
+        if float(t) >= 0:
+            if self.results_watcher is None:
+                self.results_watcher = make_async_watcher(
+                    gevent.get_hub().loop)
+                self.results_watcher.start(self.deliver_device_results)
+            result = gevent.event.AsyncResult()
+            self.pending_results.append(result)
         self.send_to_client('simulate', str(t))
+        return result
+
+    def set_result_format(self, result_format):
+        """
+        Sets the format the NEST client sends device results in.
+
+        :param result_format: Either ``json`` or ``binary``
+        """
+        self.send_to_client('result_format', result_format)
 
     def handle_device_results(self, msg):
         """
@@ -341,23 +678,497 @@ class NESTInterface(object):
         self.print('Received device results:\n' +
                    '{:>{width}}'.format(msg.value, width=len(msg.value) + 9))
         self.device_results = msg.value
+        self.received_results.append(msg.value)
+        if self.results_watcher is not None:
+            self.results_watcher.send()
+
+    def deliver_device_results(self):
+        """
+        Sets the pending results of simulations, in the order they were
+        started, to the device results received. Error results from the
+        client are raised as a ``RuntimeError`` by ``get()`` of the pending
+        result. Runs in the gevent loop.
+        """
+        while self.received_results and self.n_dropped_results:
+            self.received_results.popleft()
+            self.n_dropped_results -= 1
+        while self.received_results and self.pending_results:
+            pending = self.pending_results.popleft()
+            value = self.received_results.popleft()
+            if value.startswith(ERROR_RESULT_PREFIX):
+                pending.set_exception(
+                    RuntimeError(value[len(ERROR_RESULT_PREFIX):]))
+            else:
+                pending.set(value)
+
+    def get_results(self, result, timeout=None):
+        """
+        Waits for the device results of a simulation step. If the step
+        failed, the results of all steps still pending are dropped when they
+        arrive, so they are not mistaken for the results of later steps.
+
+        :param result: The ``AsyncResult`` returned by :meth:`simulate`
+        :param timeout: Time in seconds to wait for the results
+        :returns: the device results
+        :raises RuntimeError: if the client sent an error result, or no
+            results were received within the timeout
+        """
+        try:
+            return result.get(timeout=timeout)
+        except gevent.Timeout:
+            self.drop_pending_results()
+            raise RuntimeError(
+                'No device results received in {} s'.format(timeout))
+        except RuntimeError:
+            self.drop_pending_results()
+            raise
+
+    def drop_pending_results(self):
+        """
+        Gives up on the results of all pending simulation steps.
+        """
+        self.n_dropped_results += len(self.pending_results)
+        self.pending_results.clear()
 
     def get_device_results(self):
         return self.device_results
 
+    def handle_timings(self, msg):
+        """
+        Handles receiving the timings of a command from the NEST client.
+
+        :param msg: Nett type message with the timings, in JSON format
+        """
+        if not msg.value:
+            return
+        timings = json.loads(msg.value)
+        self.kernel_threads = timings.get('kernel_threads',
+                                          self.kernel_threads)
+        self.timings[timings.pop('command')] = timings
+
+    def get_timings(self):
+        """
+        Gets the timings of the last command of each type sent to the NEST
+        client.
+
+        :returns: dictionary of command types to the time spent in each phase
+            of the command, in seconds, and the number of connections after it
+        """
+        return dict(self.timings)
+
     def handle_status_message(self, msg):
         """
         Handles receiving status messages from the NEST client.
 
         :param msg: Nett type message with the status message
         """
-        user_id = msg.value.split()[0]
+        # The message is prefixed with the client ID, which for pooled clients
+        # differs from the ID of the user the client is assigned to.
         message = ' '.join(msg.value.split()[1:])
         self.print('Received status message:\n' +
                    '{:>{width}}'.format(message, width=len(message) + 9))
 
         self.socketio.emit('message',
                            {'message': message},
-                           namespace='/message/{}'.format(user_id))
+                           namespace='/message/{}'.format(self.user_id))
         # TODO: Use namespace to send to different clients
         print('Sent socket msg')
+
+
+class NESTClientPool(object):
+    """
+    A pool of started, idle NEST clients. Starting a client means starting a
+    new process, importing NEST and installing modules, so having clients
+    ready when users make their networks saves a considerable amount of time.
+    Clients handed out are replaced in the background.
+
+    Idle clients are given negative IDs, so that neither their IDs nor their
+    ports collide with those of user clients.
+
+    :param size: Number of idle clients to keep ready
+    :param silent: Whether the clients should be silent
+    :param socketio: The ``SocketIO`` instance passed on to the interfaces
+    """
+
+    def __init__(self, size, silent=False, socketio=None):
+        self.size = size
+        self.silent = silent
+        self.socketio = socketio
+
+        self.idle = []
+        self.lock = threading.Lock()
+        self.next_client_id = -1
+        self.n_spawning = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.n_spawned = 0
+        self.total_spawn_time = 0.
+        self.last_spawn_time = 0.
+
+        self.replenish()
+
+    def get_client_id(self):
+        """
+        Gets a new unique ID for a pooled client.
+
+        :returns: client ID
+        """
+        with self.lock:
+            client_id = self.next_client_id
+            self.next_client_id -= 1
+        return client_id
+
+    def spawn(self):
+        """
+        Starts a new idle client, and adds it to the pool.
+        """
+        try:
+            interface = NESTInterface(None,
+                                      None,
+                                      silent=self.silent,
+                                      socketio=self.socketio,
+                                      client_id=self.get_client_id())
+        except Exception as exception:
+            print('Could not start pooled NEST client:', exception)
+            with self.lock:
+                self.n_spawning -= 1
+            return
+        with self.lock:
+            self.n_spawning -= 1
+            self.n_spawned += 1
+            self.total_spawn_time += interface.spawn_time
+            self.last_spawn_time = interface.spawn_time
+            self.idle.append(interface)
+
+    def replenish(self):
+        """
+        Starts new clients in the background until the pool is full again.
+        """
+        with self.lock:
+            n_missing = self.size - len(self.idle) - self.n_spawning
+            self.n_spawning += max(n_missing, 0)
+        for _ in range(n_missing):
+            thread = threading.Thread(target=self.spawn)
+            thread.daemon = True
+            thread.start()
+
+    def acquire(self, user_id, networkSpecs, device_projections='[]'):
+        """
+        Gets an interface to a NEST client for a user, and makes the network.
+        If the pool is empty, a new client is started. If the network cannot
+        be made, the client is terminated, so no NEST process is left behind.
+
+        :param user_id: ID of the user
+        :param networkSpecs: Dictionary of network specifications
+        :param device_projections: Optional list of projections between layers
+                                   and devices
+        :returns: a :class:`NESTInterface` with the network made
+        :raises ValueError: if the network specifications are invalid
+        """
+        with self.lock:
+            interface = self.idle.pop(0) if self.idle else None
+            if interface is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        self.replenish()
+
+        if interface is None:
+            interface = NESTInterface(None,
+                                      None,
+                                      silent=self.silent,
+                                      socketio=self.socketio,
+                                      client_id=user_id)
+        try:
+            interface.assign(user_id, networkSpecs, device_projections)
+        except Exception:
+            interface.close()
+            raise
+        return interface
+
+    def get_stats(self):
+        """
+        Gets the counters of the pool.
+
+        :returns: dictionary with hit and miss counts, and spawn latencies in
+            seconds
+        """
+        with self.lock:
+            return {'size': self.size,
+                    'idle': len(self.idle),
+                    'spawning': self.n_spawning,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'spawned': self.n_spawned,
+                    'last_spawn_time': self.last_spawn_time,
+                    'mean_spawn_time': (self.total_spawn_time /
+                                        self.n_spawned
+                                        if self.n_spawned else 0.)}
+
+
+class ChunkScheduler(object):
+    """
+    Decides how long each chunk of a streamed simulation should be. The
+    length of the next chunk is adjusted from the wall time and result size of
+    the previous chunks, so that updates reach the user at a target rate. The
+    first chunk is kept small so the first results arrive quickly.
+
+    :param t: Total time to simulate, in ms
+    :param target_rate: Target number of updates per second
+    :param first_dt: Simulation time of the first chunk, in ms
+    :param min_dt: Minimum simulation time of a chunk, in ms
+    :param max_dt: Maximum simulation time of a chunk, in ms
+    :param max_result_size: Result size, in bytes, above which chunks are
+                            shortened regardless of wall time
+    :param max_growth: Maximum factor to grow or shrink a chunk by at a time
+    :param resolution: Simulation resolution, in ms. Chunks are always a
+                       multiple of the resolution.
+    """
+
+    def __init__(self, t,
+                 target_rate=10.,
+                 first_dt=1.,
+                 min_dt=0.1,
+                 max_dt=1000.,
+                 max_result_size=2**20,
+                 max_growth=2.,
+                 resolution=0.1):
+        self.t = float(t)
+        self.target_period = 1. / target_rate
+        self.min_dt = min_dt
+        self.max_dt = max_dt
+        self.max_result_size = max_result_size
+        self.max_growth = max_growth
+        self.resolution = resolution
+
+        self.simulated = 0.
+        self.n_chunks = 0
+        self.dt = self.clamp(first_dt)
+
+    def clamp(self, dt):
+        """
+        Clamps a chunk length to the allowed range, and rounds it to a
+        multiple of the resolution.
+
+        :param dt: chunk length, in ms
+        :returns: the clamped chunk length
+        """
+        return self.to_resolution(min(max(dt, self.min_dt), self.max_dt))
+
+    def to_resolution(self, dt):
+        """
+        Rounds a time to a non-zero multiple of the resolution.
+
+        :param dt: time, in ms
+        :returns: the rounded time
+        """
+        steps = max(round(dt / self.resolution), 1)
+        return round(steps * self.resolution, 10)
+
+    def done(self):
+        """
+        Checks if the whole simulation time has been handed out.
+
+        :returns: `True` if the simulation is done
+        """
+        return self.t - self.simulated < self.resolution / 2.
+
+    def next_dt(self):
+        """
+        Gets the simulation time of the next chunk, and counts it as
+        simulated.
+
+        :returns: simulation time of the next chunk, in ms
+        """
+        dt = self.to_resolution(min(self.dt, self.t - self.simulated))
+        self.simulated = round(self.simulated + dt, 10)
+        self.n_chunks += 1
+        return dt
+
+    def update(self, wall_time, result_size=0):
+        """
+        Adjusts the chunk length from the measurements of the last chunk.
+
+        :param wall_time: Wall time, in seconds, from sending the chunk to
+                          receiving its results
+        :param result_size: Size of the results, in bytes
+        """
+        scale = self.target_period / max(wall_time, 1e-6)
+        if result_size > self.max_result_size:
+            scale = min(scale, float(self.max_result_size) / result_size)
+        scale = min(max(scale, 1. / self.max_growth), self.max_growth)
+        self.dt = self.clamp(self.dt * scale)
+
+
+class JobScheduler(object):
+    """
+    Queues NEST workloads from all users, and makes sure the cores used by the
+    running workloads stay within a budget. Jobs are started in the order
+    they are submitted. Users with queued jobs are told their position in the
+    queue over their socket.io message namespace.
+
+    Must only be used from greenlets in the server.
+
+    :param core_budget: Number of cores available to NEST workloads
+    :param socketio: The ``SocketIO`` instance used to report queue positions
+    """
+
+    def __init__(self, core_budget, socketio=None):
+        self.core_budget = core_budget
+        self.socketio = socketio
+        self.cores_in_use = 0
+        self.queue = []
+
+    @contextlib.contextmanager
+    def job(self, user_id, cores=1):
+        """
+        Context manager for running a NEST workload. Waits until there are
+        enough free cores before entering the context.
+
+        :param user_id: ID of the user the job belongs to
+        :param cores: Number of cores used by the job
+        """
+        cores = min(cores, self.core_budget)
+        started = gevent.event.Event()
+        entry = (user_id, cores, started)
+        self.queue.append(entry)
+        self.dispatch()
+        if not started.is_set():
+            try:
+                started.wait()
+            except BaseException:
+                if entry in self.queue:
+                    self.queue.remove(entry)
+                    self.report_positions()
+                else:
+                    self.release(cores)
+                raise
+            self.report_position(user_id, 0)
+        try:
+            yield
+        finally:
+            self.release(cores)
+
+    def release(self, cores):
+        """
+        Frees cores of a finished job, and starts queued jobs.
+
+        :param cores: Number of cores to free
+        """
+        self.cores_in_use -= cores
+        self.dispatch()
+
+    def dispatch(self):
+        """
+        Starts queued jobs, in order, as long as they fit within the budget.
+        """
+        while (self.queue and
+               self.cores_in_use + self.queue[0][1] <= self.core_budget):
+            user_id, cores, event = self.queue.pop(0)
+            self.cores_in_use += cores
+            event.set()
+        if self.queue:
+            self.report_positions()
+
+    def report_positions(self):
+        """
+        Sends the queue position to all users with queued jobs.
+        """
+        for position, entry in enumerate(list(self.queue)):
+            self.report_position(entry[0], position + 1)
+
+    def report_position(self, user_id, position):
+        """
+        Sends the queue position of a job to a user. Position 0 means the job
+        has started.
+
+        :param user_id: ID of the user
+        :param position: Position in the queue
+        """
+        if self.socketio is None:
+            return
+        self.socketio.emit('queue',
+                           {'position': position},
+                           namespace='/message/{}'.format(user_id))
+
+    def get_queue_length(self):
+        """
+        Gets the number of queued jobs.
+
+        :returns: number of queued jobs
+        """
+        return len(self.queue)
+
+
+class CPUPlacement(object):
+    """
+    Places the NEST clients of active sessions on disjoint sets of CPUs, and
+    sets the number of threads of each client to match. The CPUs are divided
+    evenly between the sessions, and are divided again as sessions come and
+    go. With more sessions than CPUs, sessions have to share CPUs. A new
+    number of threads takes effect the next time a client rebuilds its
+    network, so the networks of other sessions are not invalidated.
+
+    :param cpus: Optional list of CPU IDs to place clients on. Defaults to all
+                 CPUs available to the server.
+    :param max_threads: Optional maximum number of CPUs given to one session
+    """
+
+    def __init__(self, cpus=None, max_threads=None):
+        self.cpus = list(cpus) if cpus is not None else get_available_cpus()
+        self.max_threads = max_threads
+        self.sessions = collections.OrderedDict()
+
+    def add(self, user_id, interface):
+        """
+        Adds the session of a user, and rebalances placement.
+
+        :param user_id: ID of the user
+        :param interface: The :class:`NESTInterface` of the session
+        """
+        self.sessions[user_id] = interface
+        self.rebalance()
+
+    def remove(self, user_id):
+        """
+        Removes the session of a user, if present, unpins its NEST client, and
+        rebalances placement.
+
+        :param user_id: ID of the user
+        """
+        interface = self.sessions.pop(user_id, None)
+        if interface is not None:
+            interface.unpin()
+            self.rebalance()
+
+    def get_cpu_sets(self, n_sessions):
+        """
+        Divides the CPUs into sets for a number of sessions.
+
+        :param n_sessions: Number of sessions
+        :returns: list of lists of CPU IDs, one for each session
+        """
+        n_cpus = len(self.cpus)
+        if n_sessions > n_cpus:
+            return [[self.cpus[i % n_cpus]] for i in range(n_sessions)]
+        per_session, n_extra = divmod(n_cpus, n_sessions)
+        cpu_sets = []
+        start = 0
+        for i in range(n_sessions):
+            n = per_session + (1 if i < n_extra else 0)
+            if self.max_threads is not None:
+                n = min(n, self.max_threads)
+            cpu_sets.append(self.cpus[start:start + n])
+            start += per_session + (1 if i < n_extra else 0)
+        return cpu_sets
+
+    def rebalance(self):
+        """
+        Places all sessions on their share of the CPUs.
+        """
+        if not self.sessions:
+            return
+        cpu_sets = self.get_cpu_sets(len(self.sessions))
+        for interface, cpus in zip(self.sessions.values(), cpu_sets):
+            interface.set_cpus(cpus)
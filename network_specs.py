@@ -0,0 +1,876 @@
+# -*- coding: utf-8 -*-
+"""
+Handling of network specifications, independent of NEST, so that it can be
+used by both the server and the NEST client.
+
+Network specifications come in two formats. In the original format, each
+layer has a list of ``neurons``, each with ``x``, ``y`` and ``z`` keys. In
+the compact format, marked by ``"format": "compact"`` and a ``version``, each
+layer instead has ``positions``: the coordinates of all neurons, packed as
+base64 encoded little-endian float32 values, ``x``, ``y``, ``z`` per neuron.
+Specifications parsed with :func:`parse` hold the positions of each layer as
+an array under ``positions``, whatever the format.
+"""
+import re
+import json
+import math
+import base64
+import string
+import numbers
+import itertools
+import operator
+import numpy as np
+
+REQUIRED_KEYS = ['models', 'syn_models', 'layers', 'projections', 'is3DLayer']
+REQUIRED_LAYER_KEYS = ['name', 'elements', 'extent', 'center']
+COMPACT_FORMAT = 'compact'
+COMPACT_VERSION = 1
+get_xyz = operator.itemgetter('x', 'y', 'z')
+NEURONS_START = re.compile(r'"neurons"\s*:\s*\[')
+COORDINATE_KEY = re.compile(r'"([xyz])"\s*:')
+# Turns a list of neurons into whitespace separated coordinates.
+NEURON_SEPARATORS = string.maketrans('{}":,xyz', ' ' * 8)
+# Average number of positions in each cell of a SpatialIndex.
+POINTS_PER_CELL = 8
+# Tolerance of the bounds of box masks, as in NEST.
+BOX_MASK_EPSILON = 1e-12
+# Relative margin added to the bounding boxes of masks, so that positions on
+# the edge of a mask are not missed because of rounding.
+MASK_BOUNDS_MARGIN = 1e-9
+
+
+def parse(networkSpecs):
+    """
+    Parses network specifications in JSON format. The lists of neurons, which
+    make up most of the specifications in the original format, are not
+    decoded to dictionaries, but read straight into arrays one layer at a
+    time, so that peak memory stays close to the size of the specifications.
+
+    :param networkSpecs: Network specifications, in JSON format
+    :returns: dictionary of network specifications, where each layer has its
+        positions as a ``float64`` array, with one row per neuron, under
+        ``positions``
+    """
+    pieces = []
+    layer_positions = []
+    start = 0
+    try:
+        for match in NEURONS_START.finditer(networkSpecs):
+            end = networkSpecs.index(']', match.end())
+            if networkSpecs.find('[', match.end(), end) != -1:
+                # The neurons contain lists, so the list of neurons does not
+                # end at the first closing bracket.
+                raise ValueError('Nested list in neurons')
+            layer_positions.append(
+                read_neurons(networkSpecs, match.end(), end))
+            pieces.append(networkSpecs[start:match.end()])
+            start = end
+        pieces.append(networkSpecs[start:])
+        specs = json.loads(''.join(pieces))
+        layers = specs.get('layers', []) if isinstance(specs, dict) else []
+        matched = (sum('neurons' in layer for layer in layers) ==
+                   len(layer_positions))
+    except ValueError:
+        matched = False
+    if not matched:
+        # The neurons are not plain lists of dictionaries, or the neurons key
+        # is also used outside of the layers, so the lists cannot be matched
+        # with their layers. Any errors in the specifications are raised here.
+        specs = json.loads(networkSpecs)
+        layers = specs.get('layers', []) if isinstance(specs, dict) else []
+        layer_positions = [get_positions(layer) for layer in layers
+                           if 'neurons' in layer]
+
+    positions = iter(layer_positions)
+    for layer in layers:
+        if 'neurons' in layer:
+            del layer['neurons']
+            layer['positions'] = next(positions)
+        elif 'positions' in layer:
+            layer['positions'] = get_positions(layer)
+    return specs
+
+
+def read_neurons(text, start, end):
+    """
+    Reads the coordinates of a list of neurons in JSON format into an array.
+
+    :param text: JSON text containing the list
+    :param start: Index of the first character in the list
+    :param end: Index of the closing bracket of the list
+    :returns: ``float64`` array with one row of coordinates per neuron
+    """
+    n_neurons = text.count('{', start, end)
+    keys = COORDINATE_KEY.findall(text, start, text.find('}', start, end))
+    # The order of the keys is only taken from the first neuron, so it has to
+    # be the same in all of them.
+    same_order = COORDINATE_KEY.findall(text, start, end) == keys * n_neurons
+    try:
+        coordinates = text[start:end].encode('ascii').translate(
+            NEURON_SEPARATORS)
+        values = np.fromstring(coordinates, dtype=np.float64, sep=' ')
+    except (UnicodeError, ValueError):
+        values = None
+    if (sorted(keys) != ['x', 'y', 'z'] or not same_order or
+            values is None or values.size != 3 * n_neurons):
+        # Not plain x, y, z dictionaries, so decode the list as usual.
+        return get_positions({'neurons': json.loads(text[start - 1:end + 1])})
+
+    positions = values.reshape(-1, 3)
+    if keys != ['x', 'y', 'z']:
+        positions = positions[:, [keys.index(key) for key in 'xyz']]
+    return positions
+
+
+def validate(networkSpecs):
+    """
+    Checks that network specifications are complete and consistent, so that
+    errors are found when the specifications are received, rather than when
+    the network is built.
+
+    :param networkSpecs: Dictionary of network specifications
+    :raises ValueError: if the specifications are invalid
+    """
+    if not isinstance(networkSpecs, dict):
+        raise ValueError('Network specifications must be a dictionary')
+    for key in REQUIRED_KEYS:
+        if key not in networkSpecs:
+            raise ValueError('Network specifications are missing {}'.format(
+                key))
+
+    compact = is_compact(networkSpecs)
+    if compact and networkSpecs.get('version', 0) > COMPACT_VERSION:
+        raise ValueError('Unsupported version of the compact format: '
+                         '{}'.format(networkSpecs.get('version')))
+    elif 'format' in networkSpecs and not compact:
+        raise ValueError('Unknown network format: {}'.format(
+            networkSpecs['format']))
+
+    models = networkSpecs['models']
+    n_dims = 3 if networkSpecs['is3DLayer'] else 2
+    layer_names = set()
+    for layer in networkSpecs['layers']:
+        for key in REQUIRED_LAYER_KEYS:
+            if key not in layer:
+                raise ValueError('Layer is missing {}'.format(key))
+        name = layer['name']
+        if name in layer_names:
+            raise ValueError('Duplicate layer name: {}'.format(name))
+        layer_names.add(name)
+        if 'positions' in layer:
+            try:
+                n_neurons = len(get_positions(layer))
+            except (TypeError, ValueError):
+                raise ValueError('Layer {} has invalid positions'.format(name))
+        else:
+            n_neurons = 0 if compact else len(layer.get('neurons', []))
+        if n_neurons == 0:
+            raise ValueError('Layer {} has no neurons'.format(name))
+        if len(layer['extent']) < n_dims or len(layer['center']) < n_dims:
+            raise ValueError('Layer {} has too few dimensions'.format(name))
+        elements = layer['elements']
+        if not isinstance(elements, list):
+            elements = [elements]
+        for element in elements:
+            if (not isinstance(element, numbers.Number) and
+                    element not in models):
+                raise ValueError('Layer {} has unknown model {}'.format(
+                    name, element))
+
+    for syn_model in networkSpecs['syn_models']:
+        if len(syn_model) != 3:
+            raise ValueError('Invalid synapse model: {}'.format(syn_model))
+
+    for projection in networkSpecs['projections']:
+        if len(projection) != 3:
+            raise ValueError('Invalid projection: {}'.format(projection))
+        for name in projection[:2]:
+            if name not in layer_names:
+                raise ValueError('Projection with unknown layer {}'.format(
+                    name))
+
+
+def is_compact(networkSpecs):
+    """
+    Checks if network specifications are in the compact format.
+
+    :param networkSpecs: Dictionary of network specifications
+    :returns: `True` if the specifications are in the compact format
+    """
+    return networkSpecs.get('format') == COMPACT_FORMAT
+
+
+def encode_positions(positions):
+    """
+    Packs positions as in the compact format.
+
+    :param positions: Array or nested list with the x, y and z coordinates of
+                      each neuron
+    :returns: base64 encoded float32 values
+    """
+    return base64.b64encode(
+        np.ascontiguousarray(positions, dtype='<f4').tobytes())
+
+
+def decode_positions(encoded):
+    """
+    Unpacks positions in the compact format.
+
+    :param encoded: base64 encoded float32 values
+    :returns: flat ``float32`` array of coordinates
+    """
+    return np.frombuffer(base64.b64decode(encoded), dtype='<f4')
+
+
+def make_compact(networkSpecs):
+    """
+    Converts network specifications to the compact format.
+
+    :param networkSpecs: Dictionary of network specifications, in either
+                         format
+    :returns: a new dictionary of network specifications in the compact
+        format
+    """
+    compact_specs = dict(networkSpecs, format=COMPACT_FORMAT,
+                         version=COMPACT_VERSION, layers=[])
+    for layer in networkSpecs['layers']:
+        compact_layer = {key: value for key, value in layer.items()
+                         if key != 'neurons'}
+        compact_layer['positions'] = encode_positions(get_positions(layer))
+        compact_specs['layers'].append(compact_layer)
+    return compact_specs
+
+
+def get_positions(layer, is3DLayer=True):
+    """
+    Converts the positions of the neurons in a layer to an array.
+
+    :param layer: Layer from the network specifications, in either format, or
+                  parsed by :func:`parse`
+    :param is3DLayer: If `False`, the z coordinates are left out
+    :returns: contiguous ``float64`` array with one row of coordinates per
+        neuron
+    """
+    if isinstance(layer.get('positions'), np.ndarray):
+        positions = layer['positions']
+    elif 'positions' in layer:
+        positions = decode_positions(layer['positions']).astype(
+            np.float64).reshape(-1, 3)
+    else:
+        neurons = layer['neurons']
+        positions = np.fromiter(
+            itertools.chain.from_iterable(itertools.imap(get_xyz, neurons)),
+            dtype=np.float64, count=3 * len(neurons)).reshape(-1, 3)
+    if not is3DLayer:
+        positions = np.ascontiguousarray(positions[:, :2])
+    return positions
+
+
+def floatify(dict_to_floatify):
+    """
+    Goes through a (possibly nested) dictionary and converts numbers to
+    floats, as going via JSON turns double values into integers.
+
+    :param dict_to_floatify: dictionary to go through. It is not changed.
+    :returns: new dictionary where numbers are floats
+    """
+    floatified = {}
+    for key, value in dict_to_floatify.items():
+        if isinstance(value, dict):
+            value = floatify(value)
+        elif isinstance(value, numbers.Number):
+            value = float(value)
+        floatified[str(key)] = value
+    return floatified
+
+
+class Frozen(object):
+    """
+    Base for compiled specifications, whose attributes are set once, in the
+    constructor, and cannot be reassigned afterwards. Only the attributes are
+    protected: dictionaries and lists they refer to can still be changed in
+    place, and as they are shared by everyone using the specifications, they
+    must not be.
+    """
+    __slots__ = ()
+
+    def __init__(self, **attributes):
+        for name, value in attributes.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(
+            'Attributes of {} are read-only'.format(type(self).__name__))
+
+    def __delattr__(self, name):
+        raise AttributeError(
+            'Attributes of {} are read-only'.format(type(self).__name__))
+
+
+class CompiledLayer(Frozen):
+    """
+    A layer of compiled network specifications.
+
+    :ivar name: Name of the layer
+    :ivar elements: The elements of the layer, as given in the
+                    specifications: either a model name, or a tuple of model
+                    names, each optionally followed by a count
+    :ivar nest_elements: The elements as passed to ``CreateLayer``. A single
+                         model name is resolved to the NEST model it is
+                         copied from.
+    :ivar models: Set of model names in the layer
+    :ivar n_elements: Number of nodes at each position
+    :ivar element_ranges: Dictionary of the range of elements of each model,
+                          as a tuple of the index of its first element and
+                          the index after its last element. NEST makes the
+                          nodes of a layer one element at a time, so these
+                          are also the ranges of the model's nodes, in units
+                          of the number of positions.
+    :ivar positions: Read-only ``float64`` array of positions, with one row
+                     per neuron, and two or three columns depending on the
+                     dimension of the network
+    :ivar extent: Extent of the layer, as floats
+    :ivar center: Center of the layer, as floats
+    :ivar neuron_type: Type of neurons in the layer
+    """
+    __slots__ = ('name', 'elements', 'nest_elements', 'models', 'n_elements',
+                 'element_ranges', 'positions', 'extent', 'center',
+                 'neuron_type')
+
+    def get_element_range(self, neuron_type):
+        """
+        Gets the range of elements of a neuron type.
+
+        :param neuron_type: Name of a model, or ``All`` for all elements
+        :returns: tuple of the index of the first element and the index after
+            the last element, or `None` if the layer has no such elements
+        """
+        if neuron_type == 'All':
+            return 0, self.n_elements
+        return self.element_ranges.get(neuron_type)
+
+
+class CompiledSpecs(Frozen):
+    """
+    Network specifications compiled once, by :func:`compile_specs`, so that
+    they do not have to be walked and converted every time they are used.
+
+    :ivar models: Tuple of pairs of model names and the NEST models they are
+                  copied from
+    :ivar syn_models: Tuple of synapse models, each a tuple of the NEST
+                      model, the name of the copy and its parameters
+    :ivar layers: Tuple of :class:`CompiledLayer`, in the order of the
+                  specifications
+    :ivar layers_by_name: Dictionary of the layers, by name
+    :ivar projections: Tuple of internal projections, each a tuple of the
+                       source layer name, the target layer name, and the
+                       connection dictionary with numbers as floats
+    :ivar is3DLayer: Whether the layers are three dimensional
+    """
+    __slots__ = ('models', 'syn_models', 'layers', 'layers_by_name',
+                 'projections', 'is3DLayer')
+
+
+def get_element_ranges(elements):
+    """
+    Gets the range of elements of each model in a layer with several
+    elements at each position.
+
+    :param elements: Tuple of model names, each optionally followed by a
+                     count, on the form ``('L23pyr', 2, 'L23in', 1)`` or
+                     ``('Relay', 'Inter')``
+    :returns: dictionary of tuples of the index of the first element of each
+        model and the index after its last element
+    """
+    element_ranges = {}
+    n_elements = 0
+    for i, element in enumerate(elements):
+        if not isinstance(element, str):
+            continue
+        count = 1
+        if i + 1 < len(elements) and not isinstance(elements[i + 1], str):
+            count = int(elements[i + 1])
+        # If a model is listed more than once, its first elements are used.
+        element_ranges.setdefault(element, (n_elements, n_elements + count))
+        n_elements += count
+    return element_ranges
+
+
+def compile_specs(networkSpecs):
+    """
+    Compiles network specifications.
+
+    :param networkSpecs: Dictionary of valid network specifications, in
+                         either format, or parsed by :func:`parse`
+    :returns: a :class:`CompiledSpecs`
+    """
+    is3DLayer = bool(networkSpecs['is3DLayer'])
+    n_dims = 3 if is3DLayer else 2
+    models = {str(name): str(model)
+              for name, model in networkSpecs['models'].items()}
+
+    layers = []
+    for layer in networkSpecs['layers']:
+        elements = layer['elements']
+        if isinstance(elements, list):
+            elements = tuple(element if isinstance(element, numbers.Number)
+                             else str(element) for element in elements)
+            nest_elements = list(elements)
+            layer_models = frozenset(element for element in elements
+                                     if isinstance(element, str))
+            element_ranges = get_element_ranges(elements)
+            n_elements = max([0] + [end for start, end
+                                    in element_ranges.values()])
+        else:
+            elements = str(elements)
+            nest_elements = models[elements]
+            layer_models = frozenset([elements])
+            element_ranges = {elements: (0, 1)}
+            n_elements = 1
+        positions = np.ascontiguousarray(get_positions(layer, is3DLayer))
+        positions.flags.writeable = False
+        layers.append(CompiledLayer(
+            name=str(layer['name']),
+            elements=elements,
+            nest_elements=nest_elements,
+            models=layer_models,
+            n_elements=n_elements,
+            element_ranges=element_ranges,
+            positions=positions,
+            extent=tuple(float(ext) for ext in layer['extent'][:n_dims]),
+            center=tuple(float(cntr) for cntr in layer['center'][:n_dims]),
+            neuron_type=layer.get('neuronType', '')))
+
+    return CompiledSpecs(
+        models=tuple(sorted(models.items())),
+        syn_models=tuple((str(syn_name), str(model_name), dict(params))
+                         for syn_name, model_name, params
+                         in networkSpecs['syn_models']),
+        layers=tuple(layers),
+        layers_by_name={layer.name: layer for layer in layers},
+        projections=tuple((str(pre), str(post), floatify(conndict))
+                          for pre, post, conndict
+                          in networkSpecs['projections']),
+        is3DLayer=is3DLayer)
+
+
+def make_mask_spec(lower_left, upper_right, mask_type, azimuth_angle,
+                   polar_angle, cntr):
+    """
+    Makes the specifications of a NEST mask from a selection.
+
+    :param lower_left: Coordinates for lower left of the selection.
+    :param upper_right: Coordinates for upper right of the selection.
+    :param mask_type: Shape of the mask. Either ``rectangular``,
+                      ``elliptical``, ``box`` or ``ellipsoidal``.
+    :param azimuth_angle: Rotation angle in degrees from x-axis.
+    :param polar_angle: Rotation angle in degrees from z-axis.
+    :param cntr: Coordinates for the centre of the layer.
+    :returns: dictionary of mask specifications, as passed to ``CreateMask``
+    """
+    if mask_type == 'rectangular':
+        spec = {'lower_left': [lower_left[0] - cntr[0],
+                               lower_left[1] - cntr[1]],
+                'upper_right': [upper_right[0] - cntr[0],
+                                upper_right[1] - cntr[1]],
+                'azimuth_angle': azimuth_angle
+                }
+    elif mask_type == 'elliptical':
+        # Calculate centre of ellipse
+        xpos = (upper_right[0] + lower_left[0]) / 2.0
+        ypos = (upper_right[1] + lower_left[1]) / 2.0
+        # Find major and minor axis
+        x_side = upper_right[0] - lower_left[0]
+        y_side = upper_right[1] - lower_left[1]
+        if x_side >= y_side:
+            major = x_side
+            minor = y_side
+        else:
+            major = y_side
+            minor = x_side
+        spec = {'major_axis': major, 'minor_axis': minor,
+                'anchor': [xpos - cntr[0], ypos - cntr[1]],
+                'azimuth_angle': azimuth_angle
+                }
+    elif mask_type == 'box':
+        spec = {'lower_left': [lower_left[0] - cntr[0],
+                               lower_left[1] - cntr[1],
+                               lower_left[2]],
+                'upper_right': [upper_right[0] - cntr[0],
+                                upper_right[1] - cntr[1],
+                                upper_right[2]],
+                'azimuth_angle': azimuth_angle,
+                'polar_angle': polar_angle
+                }
+    elif mask_type == 'ellipsoidal':
+        # Calculate centre of ellipse
+        xpos = (upper_right[0] + lower_left[0]) / 2.0
+        ypos = (upper_right[1] + lower_left[1]) / 2.0
+        zpos = (upper_right[2] + lower_left[2]) / 2.0
+        # Find major and minor axis
+        x_side = upper_right[0] - lower_left[0]
+        y_side = upper_right[1] - lower_left[1]
+        z_side = upper_right[2] - lower_left[2]
+        if x_side >= y_side:
+            major = x_side
+            minor = y_side
+        else:
+            major = y_side
+            minor = x_side
+        spec = {'major_axis': major, 'minor_axis': minor,
+                'polar_axis': z_side,
+                'anchor': [xpos - cntr[0], ypos - cntr[1], zpos],
+                'azimuth_angle': azimuth_angle,
+                'polar_angle': polar_angle}
+    else:
+        raise ValueError('Invalid mask type: %s' % mask_type)
+    return spec
+
+
+def get_selection_mask(selection_dict):
+    """
+    Gets the mask of a selection made in the GUI.
+
+    :param selection_dict: Dictionary containing specifications of the
+                           selected areas.
+    :returns: tuple of the shape of the mask, the mask specifications, as
+        made by :func:`make_mask_spec`, and the anchor of the mask
+    """
+    selection = selection_dict['selection']
+    mask_type = selection_dict['maskShape']
+    azimuth_angle = float(selection_dict['azimuthAngle']) * 180 / math.pi
+    if 'polarAngle' in selection_dict:
+        polar_angle = float(selection_dict['polarAngle']) * 180 / math.pi
+    else:
+        polar_angle = 0.0
+
+    ll = [selection['ll']['x'], selection['ll']['y'], selection['ll']['z']]
+    ur = [selection['ur']['x'], selection['ur']['y'], selection['ur']['z']]
+
+    # TODO: There must be a better way to do this. Also, centre in origo is
+    # not always correct. Also, does SelectNodesByMask really need to be
+    # sent cntr? Could it work if we said that it start in origo at c++
+    # level? What happens if layer is outside origo?
+    if (ll[2] == ur[2]):
+        cntr = [0.0, 0.0]
+    else:
+        cntr = [0.0, 0.0, 0.0]
+    spec = make_mask_spec(ll, ur, mask_type, azimuth_angle, polar_angle, cntr)
+    return mask_type, spec, cntr
+
+
+def get_mask_dimensions(mask_type):
+    """
+    Gets the number of dimensions of a mask.
+
+    :param mask_type: Shape of the mask
+    :returns: 2 or 3
+    """
+    if mask_type in ('rectangular', 'elliptical'):
+        return 2
+    if mask_type in ('box', 'ellipsoidal'):
+        return 3
+    raise ValueError('Invalid mask type: %s' % mask_type)
+
+
+def rotate(offsets, azimuth_angle, polar_angle):
+    """
+    Rotates offsets from the centre of a mask back, by the negative azimuth
+    and polar angles, the way NEST does to check if positions are inside a
+    rotated mask.
+
+    :param offsets: Array of offsets, one row per position
+    :param azimuth_angle: Rotation angle in degrees from x-axis
+    :param polar_angle: Rotation angle in degrees from z-axis
+    :returns: list of arrays of the rotated coordinates, one per dimension
+    """
+    azimuth_cos = math.cos(math.radians(azimuth_angle))
+    azimuth_sin = math.sin(math.radians(azimuth_angle))
+    x = offsets[:, 0]
+    y = offsets[:, 1]
+    if offsets.shape[1] == 2:
+        return [x * azimuth_cos + y * azimuth_sin,
+                -x * azimuth_sin + y * azimuth_cos]
+    polar_cos = math.cos(math.radians(polar_angle))
+    polar_sin = math.sin(math.radians(polar_angle))
+    z = offsets[:, 2]
+    return [x * azimuth_cos * polar_cos + y * azimuth_sin * polar_cos -
+            z * polar_sin,
+            -x * azimuth_sin + y * azimuth_cos,
+            x * azimuth_cos * polar_sin + y * azimuth_sin * polar_sin +
+            z * polar_cos]
+
+
+def get_rotation_matrix(azimuth_angle, polar_angle, n_dims):
+    """
+    Gets the matrix of :func:`rotate`. As the matrix is orthogonal, its
+    transpose rotates the mask itself.
+
+    :param azimuth_angle: Rotation angle in degrees from x-axis
+    :param polar_angle: Rotation angle in degrees from z-axis
+    :param n_dims: Number of dimensions
+    :returns: ``n_dims`` by ``n_dims`` array
+    """
+    return np.array(rotate(np.eye(n_dims), azimuth_angle, polar_angle))
+
+
+def get_mask_axes(mask_type, spec):
+    """
+    Gets the centre and the semi-axes of an elliptical or ellipsoidal mask.
+
+    :param mask_type: Shape of the mask
+    :param spec: Mask specifications, as made by :func:`make_mask_spec`
+    :returns: tuple of the centre and the semi-axes, as arrays
+    """
+    axes = [spec['major_axis'], spec['minor_axis']]
+    if mask_type == 'ellipsoidal':
+        axes.append(spec['polar_axis'])
+    axes = np.array(axes, dtype=np.float64)
+    if np.any(axes <= 0):
+        raise ValueError('The axes of a {} mask must be positive'.format(
+            mask_type))
+    return np.array(spec['anchor'], dtype=np.float64), axes / 2.
+
+
+def get_mask_bounds(mask_type, spec):
+    """
+    Gets the bounding box of a mask.
+
+    :param mask_type: Shape of the mask
+    :param spec: Mask specifications, as made by :func:`make_mask_spec`
+    :returns: tuple of the lower and upper corners of the bounding box, as
+        arrays
+    """
+    n_dims = get_mask_dimensions(mask_type)
+    rotation = get_rotation_matrix(spec.get('azimuth_angle', 0.),
+                                   spec.get('polar_angle', 0.), n_dims)
+    if mask_type in ('rectangular', 'box'):
+        lower = np.array(spec['lower_left'], dtype=np.float64)
+        upper = np.array(spec['upper_right'], dtype=np.float64)
+        center = (upper + lower) * 0.5
+        corners = np.array(list(itertools.product(*zip(lower, upper))))
+        corners = center + (corners - center).dot(rotation)
+        lower = np.minimum(lower, corners.min(axis=0))
+        upper = np.maximum(upper, corners.max(axis=0))
+    else:
+        center, semi_axes = get_mask_axes(mask_type, spec)
+        half_widths = np.sqrt((rotation ** 2 *
+                               (semi_axes ** 2)[:, np.newaxis]).sum(axis=0))
+        lower = center - half_widths
+        upper = center + half_widths
+    margin = MASK_BOUNDS_MARGIN * (1. + np.maximum(abs(lower), abs(upper)))
+    return lower - margin, upper + margin
+
+
+def mask_contains(mask_type, spec, points):
+    """
+    Checks which positions are inside a mask, with the same rules as NEST.
+
+    :param mask_type: Shape of the mask
+    :param spec: Mask specifications, as made by :func:`make_mask_spec`
+    :param points: Array of positions, one row per position
+    :returns: boolean array, `True` for the positions inside the mask
+    """
+    azimuth_angle = spec.get('azimuth_angle', 0.)
+    polar_angle = spec.get('polar_angle', 0.)
+    if mask_type in ('rectangular', 'box'):
+        lower = np.array(spec['lower_left'], dtype=np.float64)
+        upper = np.array(spec['upper_right'], dtype=np.float64)
+        if azimuth_angle or polar_angle:
+            # Rotate the positions back around the centre of the box, and
+            # check if they are inside the box without rotation.
+            center = (upper + lower) * 0.5
+            points = np.column_stack(
+                rotate(points - center, azimuth_angle, polar_angle)) + center
+        return np.all((points >= lower - BOX_MASK_EPSILON) &
+                      (points <= upper + BOX_MASK_EPSILON), axis=1)
+    center, semi_axes = get_mask_axes(mask_type, spec)
+    distance = np.zeros(len(points))
+    for coordinate, semi_axis in zip(
+            rotate(points - center, azimuth_angle, polar_angle), semi_axes):
+        distance += coordinate ** 2 * (1. / semi_axis ** 2)
+    return distance <= 1
+
+
+class SpatialIndex(object):
+    """
+    A uniform grid over the positions of a layer, for finding the positions
+    inside a mask by checking only the positions in the grid cells the mask
+    overlaps, instead of all positions of the layer.
+
+    :param positions: Array of positions, one row per position
+    :param points_per_cell: Average number of positions in each cell
+    """
+
+    def __init__(self, positions, points_per_cell=POINTS_PER_CELL):
+        self.positions = np.asarray(positions, dtype=np.float64)
+        n_points, n_dims = self.positions.shape
+        if n_points:
+            self.lower = self.positions.min(axis=0)
+            self.upper = self.positions.max(axis=0)
+        else:
+            self.lower = self.upper = np.zeros(n_dims)
+
+        # Cells are about equally long in all dimensions the positions are
+        # spread over.
+        spans = self.upper - self.lower
+        spread = spans > 0
+        n_cells = max(1., float(n_points) / points_per_cell)
+        if spread.any():
+            cell_length = (np.prod(spans[spread]) /
+                           n_cells) ** (1. / spread.sum())
+            self.shape = np.where(
+                spread, np.ceil(spans / cell_length), 1).astype(np.intp)
+        else:
+            self.shape = np.ones(n_dims, dtype=np.intp)
+        self.cell_size = np.where(spread, spans / self.shape, 1.)
+        self.strides = np.append(np.cumprod(self.shape[:0:-1])[::-1], 1)
+
+        # Positions sorted by cell, with the start of each cell in the
+        # sorted positions.
+        cell_ids = self.get_cells(self.positions).dot(self.strides)
+        self.order = np.argsort(cell_ids, kind='mergesort')
+        self.cell_starts = np.searchsorted(cell_ids[self.order],
+                                           np.arange(np.prod(self.shape) + 1))
+
+    def get_cells(self, points):
+        """
+        Gets the cells positions are in. Positions outside the grid are put
+        in the nearest cell.
+
+        :param points: Array of positions, or a single position
+        :returns: array of cell indices in each dimension
+        """
+        cells = np.floor((points - self.lower) / self.cell_size)
+        return np.clip(cells, 0, self.shape - 1).astype(np.intp)
+
+    def get_candidates(self, lower, upper):
+        """
+        Gets the positions in the cells overlapping a box.
+
+        :param lower: Lower corner of the box
+        :param upper: Upper corner of the box
+        :returns: array of indices of the positions
+        """
+        if np.any(lower > self.upper) or np.any(upper < self.lower):
+            return np.array([], dtype=np.intp)
+        lower_cell = self.get_cells(lower)
+        upper_cell = self.get_cells(upper)
+        # Cells next to each other in the last dimension are next to each
+        # other in the sorted positions, so each row of cells is one range.
+        rows = np.zeros(1, dtype=np.intp)
+        for dim in range(len(self.shape) - 1):
+            cells = np.arange(lower_cell[dim], upper_cell[dim] + 1)
+            rows = (rows[:, np.newaxis] +
+                    cells * self.strides[dim]).ravel()
+        rows += lower_cell[-1]
+        starts = self.cell_starts[rows]
+        ends = self.cell_starts[rows + upper_cell[-1] - lower_cell[-1] + 1]
+        lengths = ends - starts
+        offsets = (np.repeat(starts - np.cumsum(lengths) + lengths, lengths) +
+                   np.arange(lengths.sum()))
+        return self.order[offsets]
+
+    def select(self, mask_type, spec, anchor=None):
+        """
+        Selects the positions inside a mask, like ``SelectNodesByMask``.
+
+        :param mask_type: Shape of the mask
+        :param spec: Mask specifications, as made by :func:`make_mask_spec`
+        :param anchor: Optional position the mask is moved to
+        :returns: sorted array of indices of the positions inside the mask
+        """
+        if get_mask_dimensions(mask_type) != self.positions.shape[1]:
+            raise ValueError('A {} mask cannot be used with {}D '
+                             'positions'.format(mask_type,
+                                                self.positions.shape[1]))
+        anchor = np.zeros(self.positions.shape[1]) if anchor is None \
+            else np.asarray(anchor, dtype=np.float64)
+        lower, upper = get_mask_bounds(mask_type, spec)
+        candidates = self.get_candidates(lower + anchor, upper + anchor)
+        inside = mask_contains(mask_type, spec,
+                               self.positions[candidates] - anchor)
+        return np.sort(candidates[inside])
+
+
+class LayerSelector(object):
+    """
+    Finds the positions in selections made in the GUI, from compiled network
+    specifications, without NEST. A :class:`SpatialIndex` is made for each
+    layer the first time it is needed.
+
+    :param network: A :class:`CompiledSpecs`
+    """
+
+    def __init__(self, network):
+        self.network = network
+        self.spatial_indices = {}
+
+    def get_spatial_index(self, name):
+        """
+        Gets the spatial index of the positions of a layer.
+
+        :param name: Name of the layer
+        :returns: a :class:`SpatialIndex`
+        """
+        if name not in self.spatial_indices:
+            self.spatial_indices[name] = SpatialIndex(
+                self.network.layers_by_name[name].positions)
+        return self.spatial_indices[name]
+
+    def select(self, selection_dict):
+        """
+        Selects the positions of each layer inside a selection, for the layers
+        with elements of the selected neuron type.
+
+        :param selection_dict: Dictionary containing specifications of the
+                               selected areas.
+        :returns: list of tuples of the :class:`CompiledLayer`, the range of
+            selected elements, as returned by
+            :meth:`CompiledLayer.get_element_range`, and a sorted array of
+            indices of the selected positions
+        """
+        mask_type, spec, anchor = get_selection_mask(selection_dict)
+        selected = []
+        # In case of a 3D layer, we have to go through all the layer names in
+        # the selection_dict, because we only have one dict for the selection,
+        # but the area might encompass several layers.
+        for name in selection_dict['name']:
+            layer = self.network.layers_by_name[name]
+            element_range = layer.get_element_range(
+                selection_dict['neuronType'])
+            if element_range is None:
+                continue
+            positions = self.get_spatial_index(name).select(mask_type, spec,
+                                                            anchor)
+            selected.append((layer, element_range, positions))
+        return selected
+
+    def count(self, selection_dict):
+        """
+        Counts the neurons in a selection.
+
+        :param selection_dict: Dictionary containing specifications of the
+                               selected areas.
+        :returns: dictionary with the number of selected neurons, and for
+            each layer, the number of selected neurons, and the number of
+            neurons of each type inside the selection
+        """
+        mask_type, spec, anchor = get_selection_mask(selection_dict)
+        layers = {}
+        total = 0
+        for name in selection_dict['name']:
+            layer = self.network.layers_by_name[name]
+            n_positions = len(self.get_spatial_index(name).select(
+                mask_type, spec, anchor))
+            element_range = layer.get_element_range(
+                selection_dict['neuronType'])
+            n_neurons = (n_positions * (element_range[1] - element_range[0])
+                         if element_range is not None else 0)
+            layers[name] = {
+                'neurons': n_neurons,
+                'types': {model: n_positions * (end - start)
+                          for model, (start, end)
+                          in layer.element_ranges.items()}}
+            total += n_neurons
+        return {'neurons': total, 'layers': layers}
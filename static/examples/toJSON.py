@@ -1,8 +1,15 @@
+import os
+import sys
 import json
 import numpy as np
 
+# The compact format is made by network_specs, in the top directory.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..'))
+from network_specs import make_compact  # noqa: E402
 
-def convert(specs, conn_specs, file_name, model_name=None):
+
+def convert(specs, conn_specs, file_name, model_name=None, compact=False):
     if model_name is None:
         model_name = file_name
     json_dict = {"layers": []}
@@ -91,5 +98,18 @@ def convert(specs, conn_specs, file_name, model_name=None):
     json_dict["projections"] = conn_specs
     # print("##############################")
     # pprint.pprint(json_dict)
+    if compact:
+        json_dict = make_compact(json_dict)
     with open(file_name + '.json', 'w') as fp:
         json.dump(json_dict, fp)
+
+
+if __name__ == '__main__':
+    # Converts an existing model to the compact format:
+    # python toJSON.py --compact model.json model_compact.json
+    if len(sys.argv) != 4 or sys.argv[1] != '--compact':
+        sys.exit('Usage: python toJSON.py --compact <input> <output>')
+    with open(sys.argv[2]) as fp:
+        model = json.load(fp)
+    with open(sys.argv[3], 'w') as fp:
+        json.dump(make_compact(model), fp)
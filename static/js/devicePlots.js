@@ -340,6 +340,75 @@ class DevicePlots {
         path.exit().remove();
     }
 
+    /**
+    * Decode a binary frame of device results, as sent by the server when
+    * streaming binary results.
+    *
+    * @param {ArrayBuffer} buffer The binary frame.
+    * @returns {Object} Results with the same layout as the JSON results,
+    * <code>stream_results</code> and <code>plot_results</code>, where the
+    * values are typed arrays.
+    */
+    decodeFrame(buffer)
+    {
+        var typedArrays = {'<i4': Int32Array, '<f4': Float32Array, '<f8': Float64Array};
+        var headerLength = new DataView(buffer).getUint32(0, true);
+        var headerBytes = new Uint8Array(buffer, 4, headerLength);
+        var header = JSON.parse(String.fromCharCode.apply(null, headerBytes));
+        var bodyOffset = 4 + headerLength;
+
+        var arrays = {};
+        for ( var name in header.arrays )
+        {
+            var dtype = header.arrays[name][0];
+            var offset = header.arrays[name][1];
+            var length = header.arrays[name][2];
+            arrays[name] = new typedArrays[dtype](buffer, bodyOffset + offset, length);
+        }
+
+        // Results of each recording device, as columns of senders, times
+        // and, for voltmeters, membrane potentials.
+        var streamResults = {};
+        for ( var device of header.devices )
+        {
+            streamResults[device] = {
+                senders: arrays[device + '/senders'],
+                times: arrays[device + '/times']
+            };
+            if ( arrays[device + '/V_m'] !== undefined )
+            {
+                streamResults[device].V_m = arrays[device + '/V_m'];
+            }
+        }
+
+        // Membrane potentials are sent as one array, split into rows by time,
+        // with a column for each sender.
+        var VmRows = [];
+        var VmSenders = arrays['rec_dev/senders'];
+        var VmTimes = arrays['rec_dev/times'];
+        for ( var row = 0 ; row < VmTimes.length ; ++row )
+        {
+            var start = row * VmSenders.length;
+            VmRows.push(arrays['rec_dev/V_m'].subarray(start, start + VmSenders.length));
+        }
+
+        var lfp = {times: arrays['lfp_det/times']};
+        for ( var ch = 0 ; ch < 16 ; ++ch )
+        {
+            lfp[ch] = {lfp: arrays['lfp_det/' + ch + '/lfp']};
+        }
+
+        return {
+            stream_results: streamResults,
+            plot_results: {
+                time: header.time,
+                spike_det: {senders: arrays['spike_det/senders'], times: arrays['spike_det/times']},
+                rec_dev: {times: VmTimes, senders: VmSenders, V_m: VmRows},
+                lfp_det: lfp
+            }
+        };
+    }
+
     makeLFPPlot(events)
     {
         if ( d3.select('#LFPplot').select('svg').empty() )
@@ -124,6 +124,26 @@ class App
         this.statusSocket.on('message', function(data){
             this.showModalMessage(`The server encountered the following error: ${data.message}`);
         }.bind(this));
+        this.statusSocket.on('queue', function(data){
+            if ( data.position > 0 )
+            {
+                this.$("#infoconnected").html( `Waiting for NEST | position ${data.position} in queue` );
+            }
+            else
+            {
+                this.$("#infoconnected").html( "Running..." );
+            }
+        }.bind(this));
+
+        // Binary simulation data
+        let dataHost = `https://${window.location.host}/simulationData/${this.userID}`;
+        this.dataSocket = io(dataHost);
+        this.dataSocket.on('simulation_data', function(buffer){
+            this.showSimulationData(this.devicePlots.decodeFrame(buffer));
+        }.bind(this));
+        this.dataSocket.on('simulation_end', function(data){
+            this.onSimulationEnd();
+        }.bind(this));
 
         this.stateCheckpoint();
 
@@ -667,26 +687,31 @@ class App
      */
     handleSimulationData( e )
     {
-        var data;
-        var recordedData;
-        var deviceData;
-        var time;
-        try 
+        var data = JSON.parse(e.data);
+        if ( data.simulation_end )
         {
-            data = JSON.parse(e.data);
-            recordedData = data.stream_results;
-            deviceData = data.plot_results;
-            time = deviceData.time;
+            this.onSimulationEnd();
+            return;
         }
-        catch ( err )
+        if ( data.plot_results === undefined )
         {
-            if (data.simulation_end)
-            {
-                this.onSimulationEnd();
-                return;
-            }
-            throw err;
+            throw new Error( "Simulation data without plot_results" );
         }
+        this.showSimulationData(data);
+    }
+
+    /**
+     * Shows results of a simulation step, colouring the nodes and plotting
+     * the results.
+     *
+     * @param {Object} data Results, containing <code>stream_results</code>
+     * and <code>plot_results</code>.
+     */
+    showSimulationData( data )
+    {
+        var recordedData = data.stream_results;
+        var deviceData = data.plot_results;
+        var time = deviceData.time;
 
         this.hideLoadingOverlay();
         this.$("#infoconnected").html( "Simulating | " + time.toString() + " ms" );
@@ -898,22 +923,24 @@ class App
      */
     colorFromVm( response, spiked )
     {
-        var time = 0;
-        var V_m = 0;
+        var spikedGIDs = new Set( spiked );
         var point;
         for ( var device in response )
         {
             var deviceModel = device.slice( 0, device.lastIndexOf( "_" ) );
             if ( deviceModel === "voltmeter" )
             {
-                for ( var gid in response[ device ] )
+                var senders = response[ device ].senders;
+                var V_m = response[ device ].V_m;
+                // Events are in time order, so the last colour set for a node
+                // is from its latest membrane potential.
+                for ( var i = 0 ; i < senders.length ; ++i )
                 {
-                    if ( spiked.indexOf( gid ) === -1 ) // if GID did not spike
+                    if ( !spikedGIDs.has( senders[ i ] ) ) // if GID did not spike
                     {
-                        point = this.getGIDPoint( gid );
-                        V_m = response[ device ][ gid ][ 1 ];
+                        point = this.getGIDPoint( senders[ i ] );
                         // TODO: Vm range should be variable
-                        var colorVm = this.mapVmToColor( V_m, -70.0, -50.0 );
+                        var colorVm = this.mapVmToColor( V_m[ i ], -70.0, -50.0 );
 
                         var points = this.layer_points[ point.layer ].points;
                         var colors = points.geometry.getAttribute( "customColor" ).array;
@@ -936,8 +963,6 @@ class App
      */
     colorFromSpike( response )
     {
-        var time = 0;
-        var V_m = 0;
         var point;
         var spikedGIDs = [];
         for ( var device in response )
@@ -945,9 +970,10 @@ class App
             var deviceModel = device.slice( 0, device.lastIndexOf( "_" ) );
             if ( deviceModel === "spike_detector" )
             {
-                for ( var gid in response[ device ] )
+                var senders = response[ device ].senders;
+                for ( var i = 0 ; i < senders.length ; ++i )
                 {
-                    point = this.getGIDPoint( gid );
+                    point = this.getGIDPoint( senders[ i ] );
                     var colorSpike = [ 0.9, 0.0, 0.0 ];
 
                     var points = this.layer_points[ point.layer ].points;
@@ -956,7 +982,7 @@ class App
                     colors[ point.pointIndex ] = colorSpike[ 0 ];
                     colors[ point.pointIndex + 1 ] = colorSpike[ 1 ];
                     colors[ point.pointIndex + 2 ] = colorSpike[ 2 ];
-                    spikedGIDs.push( gid );
+                    spikedGIDs.push( senders[ i ] );
                 }
             }
         }
@@ -1208,9 +1234,9 @@ class App
             data: JSON.stringify(
             {
                 userID: this.userID,
-                network: this.modelParameters,
                 projections: this.makeProjections( true ),
-                time: "20000"
+                time: "20000",
+                binary: true
             } ),
             dataType: "json"
         } ).done( function( data )
@@ -61,7 +61,7 @@ class Brain
                     // points: new initPoints( layers[layer].neurons, offset_x, offset_y ),
                     // but then I think we would have to rewrite some of the code below.
                     app.layer_points[ layers[ layer ].name ] = {
-                        points: this.initPoints( layers[ layer ].neurons, offset_x, offset_y, layers[layer].extent, layers[layer].center, layers[layer].neuronType ),
+                        points: this.initPoints( this.getLayerPositions( layers[ layer ] ), offset_x, offset_y, layers[layer].extent, layers[layer].center, layers[layer].neuronType ),
                         offsets:
                             {
                                 x: offset_x,
@@ -93,12 +93,8 @@ class Brain
         {
             type: "POST",
             contentType: "application/json; charset=utf-8",
-            url: "/makeNetwork",
-            data: JSON.stringify(
-            {
-                userID : app.userID,
-                network: app.modelParameters
-            } ),
+            url: "/makeNetwork?userID=" + app.userID,
+            data: JSON.stringify( app.modelParameters ),
             success: function( data )
             {
                 app.hideLoadingOverlay();
@@ -112,6 +108,11 @@ class Brain
                 }
                 
             },
+            error: function()
+            {
+                // The reason is reported through the message socket.
+                app.hideLoadingOverlay();
+            },
             dataType: "json"
         } );
 
@@ -148,19 +149,53 @@ class Brain
         }
     }
 
+    /**
+     * Gets the positions of the nodes in a layer. In the compact model
+     * format, the positions are packed as base64 encoded little-endian
+     * float32 values, otherwise they are given as a list of neurons.
+     *
+     * @param {Object} layer Layer from the model parameters
+     * @returns {Float32Array} x, y and z coordinates of all the nodes
+     */
+    getLayerPositions( layer )
+    {
+        var positions;
+        var i;
+        if ( layer.positions !== undefined )
+        {
+            var binary = atob( layer.positions );
+            var bytes = new Uint8Array( binary.length );
+            for ( i = 0; i < binary.length; ++i )
+            {
+                bytes[ i ] = binary.charCodeAt( i );
+            }
+            return new Float32Array( bytes.buffer );
+        }
+
+        positions = new Float32Array( layer.neurons.length * 3 );
+        for ( i = 0; i < layer.neurons.length; ++i )
+        {
+            positions[ 3 * i ] = layer.neurons[ i ].x;
+            positions[ 3 * i + 1 ] = layer.neurons[ i ].y;
+            positions[ 3 * i + 2 ] = layer.neurons[ i ].z;
+        }
+        return positions;
+    }
+
     /**
      * Creates the points representing nodes.
      */
-    initPoints( neurons, offset_x, offset_y, extent, center, neuronType )
+    initPoints( nodePositions, offset_x, offset_y, extent, center, neuronType )
     {
         var geometry = new app.THREE.BufferGeometry();
 
-        var positions = new Float32Array( neurons.length * 3 );
-        var colors = new Float32Array( neurons.length * 3 );
-        var visible = new Float32Array( neurons.length );
+        var noNodes = nodePositions.length / 3;
+        var positions = new Float32Array( noNodes * 3 );
+        var colors = new Float32Array( noNodes * 3 );
+        var visible = new Float32Array( noNodes );
 
         var i = 0;
-        for ( var neuron in neurons )
+        for ( var node = 0; node < noNodes; ++node )
         {
             // TODO: Make so this is the same for 2D and 3D? We have added
             // offset for 2D so that the layers are not on top of each other
@@ -170,16 +205,16 @@ class Brain
             // and 3D would be the same.
             if ( app.is3DLayer )
             {
-                positions[ i ] = neurons[ neuron ].x;
-                positions[ i + 1 ] = neurons[ neuron ].y;
-                positions[ i + 2 ] = neurons[ neuron ].z;
+                positions[ i ] = nodePositions[ i ];
+                positions[ i + 1 ] = nodePositions[ i + 1 ];
+                positions[ i + 2 ] = nodePositions[ i + 2 ];
 
             }
             else
             {
-                positions[ i ] = ( neurons[ neuron ].x - center[0] ) / extent[0] + offset_x;
-                positions[ i + 1 ] = ( neurons[ neuron ].y - center[1] ) / extent[1] + offset_y;
-                positions[ i + 2 ] = ( neurons[ neuron ].z - center[2] ) / extent[2];
+                positions[ i ] = ( nodePositions[ i ] - center[0] ) / extent[0] + offset_x;
+                positions[ i + 1 ] = ( nodePositions[ i + 1 ] - center[1] ) / extent[1] + offset_y;
+                positions[ i + 2 ] = ( nodePositions[ i + 2 ] - center[2] ) / extent[2];
             }
 
             if ( neuronType === 'excitatory' )
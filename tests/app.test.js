@@ -152,7 +152,7 @@ test('Test handleSimulationData', () => {
         makeVoltmeterPlot: jest.fn()
     };
     let e = {
-        data: '{"plot_results":{"rec_dev":{"V_m":[[-70,-70,-70,-70],[-69.96517328370601,-69.97058344797023,-69.97411530833868,-69.96469057409006],[-69.73877348405927,-69.76270592265867,-69.79392409469823,-69.73867196291485],[-69.26640287104746,-69.31914920527167,-69.37309320711462,-69.28635861129042],[-68.54020218833176,-68.68615389078396,-68.73379468001576,-68.63662805565743],[-67.63383563570525,-67.92980437246618,-67.95385333973516,-67.82933377509188],[-66.67929187893259,-67.1040325153895,-67.08225155921052,-66.95964160447717],[-65.70305549046087,-66.23770870006803,-66.1863651933137,-66.07525044362609],[-64.72642634511188,-65.36638351257704,-65.29973570268487,-65.18145733388278]],"times":[1,2,3,4,5,6,7,8,9]},"spike_det":{"senders":[1458,1459,1498,1499,1458,1459,1498,1499,1458,1459,1498,1499,1458,1459,1498,1499,1458,1459,1498,1499,1458,1459,1498,1499,1458,1459,1498,1499,1458,1459,1498,1499,1458,1459,1498,1499],"times":[1,1,1,1,2,2,2,2,3,3,3,3,4,4,4,4,5,5,5,5,6,6,6,6,7,7,7,7,8,8,8,8,9,9,9,9]},"time":10},"stream_results":{"voltmeter_2":{"1458":[9,-65],"1459":[9,-65],"1498":[9,-65],"1499":[9,-65]}}}'
+        data: '{"plot_results":{"rec_dev":{"V_m":[[-70,-70,-70,-70],[-69.96517328370601,-69.97058344797023,-69.97411530833868,-69.96469057409006],[-69.73877348405927,-69.76270592265867,-69.79392409469823,-69.73867196291485],[-69.26640287104746,-69.31914920527167,-69.37309320711462,-69.28635861129042],[-68.54020218833176,-68.68615389078396,-68.73379468001576,-68.63662805565743],[-67.63383563570525,-67.92980437246618,-67.95385333973516,-67.82933377509188],[-66.67929187893259,-67.1040325153895,-67.08225155921052,-66.95964160447717],[-65.70305549046087,-66.23770870006803,-66.1863651933137,-66.07525044362609],[-64.72642634511188,-65.36638351257704,-65.29973570268487,-65.18145733388278]],"times":[1,2,3,4,5,6,7,8,9]},"spike_det":{"senders":[1458,1459,1498,1499,1458,1459,1498,1499,1458,1459,1498,1499,1458,1459,1498,1499,1458,1459,1498,1499,1458,1459,1498,1499,1458,1459,1498,1499,1458,1459,1498,1499,1458,1459,1498,1499],"times":[1,1,1,1,2,2,2,2,3,3,3,3,4,4,4,4,5,5,5,5,6,6,6,6,7,7,7,7,8,8,8,8,9,9,9,9]},"time":10},"stream_results":{"voltmeter_2":{"senders":[1458,1459,1498,1499],"times":[9,9,9,9],"V_m":[-65,-65,-65,-65]}}}'
     };
     let parsedData = JSON.parse(e.data);
     app.handleSimulationData( e );
@@ -293,7 +293,7 @@ test('Test colorFromVm and colorFromSpike', () => {
     var node2Color = app.mapVmToColor(-63, -70.0, -50.0);
     var node3Color = app.mapVmToColor(-55, -70.0, -50.0);
 
-    var response = {"spike_detector_3":{"2":[40.4]},"voltmeter_2":{"2":[49,-63],"3":[49,-55]}};
+    var response = {"spike_detector_3":{"senders":[2],"times":[40.4]},"voltmeter_2":{"senders":[2,3],"times":[49,49],"V_m":[-63,-55]}};
     var spiked = [];
 
     // Test that colouring from Vm works
@@ -481,9 +481,9 @@ test('Test streamSimulate', () => {
         contentType: expect.any(String),
         url: "/streamSimulate",
         data: JSON.stringify({
-            network: MODELPARAMETERS,
             projections: app.makeProjections(),
-            time: "20000"
+            time: "20000",
+            binary: true
         }),
         dataType: "json"
     });
@@ -661,4 +661,18 @@ test('Test render', () => {
     app.renderer = new app.THREE.CanvasRenderer();
     app.renderer2 = new app.THREE.CanvasRenderer();
     app.render();
-});
\ No newline at end of file
+});
+test('Test getLayerPositions', () => {
+    var brain = require('../static/js/makeBrainRepresentation.js');
+    var coordinates = [0.5, -0.25, 0.0, 1.0, 2.0, -3.5];
+    var layer = {neurons: [{x: 0.5, y: -0.25, z: 0.0},
+                           {x: 1.0, y: 2.0, z: -3.5}]};
+    var compactLayer = {
+        positions: Buffer.from(new Float32Array(coordinates).buffer).toString('base64')
+    };
+
+    var positions = brain.prototype.getLayerPositions.call({}, layer);
+    var compactPositions = brain.prototype.getLayerPositions.call({}, compactLayer);
+    expect(Array.from(positions)).toEqual(coordinates);
+    expect(Array.from(compactPositions)).toEqual(coordinates);
+});
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of converting neuron positions in the example networks, comparing
+list comprehensions over the neuron dictionaries on every build with
+converting the positions to arrays once, with
+:func:`network_specs.get_positions`, and converting the arrays to the lists
+``CreateLayer`` takes on every build.
+
+Run from the top directory, with Python 2 and NumPy, with
+
+    python tests/bench_node_positions.py
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import network_specs  # noqa: E402
+
+EXAMPLES = ['hill_tononi_3D_converted.json',
+            'brunel_3D_converted_quasi_random.json',
+            'Potjans_Diesmann_converted.json']
+REPEAT = 5
+
+
+def list_positions(specs):
+    """
+    Converts the positions as NESTClient.make_nodes used to, on every build.
+    """
+    positions = []
+    for layer in specs['layers']:
+        neurons = layer['neurons']
+        if specs['is3DLayer']:
+            pos = [[float(neuron['x']),
+                    float(neuron['y']),
+                    float(neuron['z'])]
+                   for neuron in neurons]
+        else:
+            pos = [[float(neuron['x']), float(neuron['y'])]
+                   for neuron in neurons]
+        positions.append(pos)
+    return positions
+
+
+def convert_positions(specs):
+    """
+    Converts the positions to arrays, as NESTClient does once, on receipt of
+    the network specifications.
+    """
+    return [network_specs.get_positions(layer, specs['is3DLayer'])
+            for layer in specs['layers']]
+
+
+def array_positions(arrays):
+    """
+    Converts the position arrays to the lists passed to CreateLayer, as
+    NESTClient.make_nodes does on every build.
+    """
+    return [array.tolist() for array in arrays]
+
+
+def main():
+    examples_dir = os.path.join(os.path.dirname(__file__), '..', 'static',
+                                'examples')
+    for example in EXAMPLES:
+        with open(os.path.join(examples_dir, example)) as specs_file:
+            specs = json.load(specs_file)
+        n_neurons = sum(len(layer['neurons']) for layer in specs['layers'])
+        arrays = convert_positions(specs)
+        assert list_positions(specs) == array_positions(arrays)
+
+        list_time = min(timeit.repeat(lambda: list_positions(specs),
+                                      number=1, repeat=REPEAT))
+        convert_time = min(timeit.repeat(lambda: convert_positions(specs),
+                                         number=1, repeat=REPEAT))
+        array_time = min(timeit.repeat(lambda: array_positions(arrays),
+                                       number=1, repeat=REPEAT))
+        print('{}: {} neurons'.format(example, n_neurons))
+        print('  per build, list comprehension: {:8.2f} ms'.format(
+            list_time * 1e3))
+        print('  per build, from arrays:        {:8.2f} ms  ({:.1f}x)'.format(
+            array_time * 1e3, list_time / array_time))
+        print('  once, conversion to arrays:    {:8.2f} ms'.format(
+            convert_time * 1e3))
+
+
+if __name__ == '__main__':
+    main()
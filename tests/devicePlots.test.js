@@ -43,3 +43,52 @@ test( 'Test makeVoltmeterPlot', () => {
     devicePlots.makeDevicePlot(devices);
     devicePlots.makeVoltmeterPlot( rec_dev, timestamp );
 } );
+
+test( 'Test decodeFrame', () => {
+    // Frame with one spike detector, made as the NEST client would.
+    let arrays = [['spike_detector_2/senders', Int32Array, [64]],
+                  ['spike_detector_2/times', Float64Array, [109.4]],
+                  ['spike_det/senders', Int32Array, [64]],
+                  ['spike_det/times', Float64Array, [109.4]],
+                  ['rec_dev/times', Float64Array, [1, 2]],
+                  ['rec_dev/senders', Int32Array, [3, 4]],
+                  ['rec_dev/V_m', Float32Array, [-70, -69, -68, -67]],
+                  ['lfp_det/times', Float64Array, []]];
+    for ( let ch = 0 ; ch < 16 ; ++ch )
+    {
+        arrays.push(['lfp_det/' + ch + '/lfp', Float32Array, []]);
+    }
+    let header = {time: 150.0, devices: ['spike_detector_2'], arrays: {}};
+    let dtypes = new Map([[Int32Array, '<i4'], [Float32Array, '<f4'], [Float64Array, '<f8']]);
+    let offset = 0;
+    for ( let [name, type, values] of arrays )
+    {
+        header.arrays[name] = [dtypes.get(type), offset, values.length];
+        offset += Math.ceil(values.length * type.BYTES_PER_ELEMENT / 8) * 8;
+    }
+    let headerString = JSON.stringify(header);
+    headerString += ' '.repeat((8 - (headerString.length + 4) % 8) % 8);
+    let buffer = new ArrayBuffer(4 + headerString.length + offset);
+    new DataView(buffer).setUint32(0, headerString.length, true);
+    let bytes = new Uint8Array(buffer);
+    for ( let i = 0 ; i < headerString.length ; ++i )
+    {
+        bytes[4 + i] = headerString.charCodeAt(i);
+    }
+    for ( let [name, type, values] of arrays )
+    {
+        new type(buffer, 4 + headerString.length + header.arrays[name][1], values.length).set(values);
+    }
+
+    let devicePlots = new DevicePlots();
+    let results = devicePlots.decodeFrame(buffer);
+    expect(Object.keys(results.stream_results)).toEqual(['spike_detector_2']);
+    expect(Array.from(results.stream_results.spike_detector_2.senders)).toEqual([64]);
+    expect(Array.from(results.stream_results.spike_detector_2.times)).toEqual([109.4]);
+    expect(results.stream_results.spike_detector_2.V_m).toBeUndefined();
+    expect(results.plot_results.time).toBe(150.0);
+    expect(Array.from(results.plot_results.spike_det.senders)).toEqual([64]);
+    expect(Array.from(results.plot_results.spike_det.times)).toEqual([109.4]);
+    expect(results.plot_results.rec_dev.V_m.map(row => Array.from(row))).toEqual([[-70, -69], [-68, -67]]);
+    expect(results.plot_results.lfp_det[15].lfp.length).toBe(0);
+} );
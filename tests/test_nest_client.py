@@ -1,4 +1,6 @@
 import unittest
+import shutil
+import tempfile
 import nest_client as nc
 import json
 import nett_python as nett_orig
@@ -60,6 +62,16 @@ class TestNESTClient(unittest.TestCase):
     def test_make_network_specs(self):
         """ Client make network specs """
         self.client.handle_make_network_specs(nett_spec_json)
+        positions = [[n['x'], n['y'], n['z']]
+                     for n in nett_spec['layers'][0]['neurons']]
+        layer = self.client.network.layers_by_name['exAndIn']
+        self.assertEqual(layer.positions.tolist(), positions)
+        self.assertEqual(layer.nest_elements, 'iaf_psc_alpha')
+        with self.assertRaises(AttributeError):
+            layer.name = 'renamed'
+        # The network is not built until it is needed.
+        self.assertEqual(nc.nest.GetKernelStatus()['network_size'], 1)
+        self.client.ensure_network_built()
 
         for new_model, old_model in nett_spec['models'].items():
             self.assertTrue(new_model in nc.nest.Models())
@@ -69,17 +81,62 @@ class TestNESTClient(unittest.TestCase):
         for old_syn_model, new_syn_model, args in nett_spec['syn_models']:
             self.assertTrue(new_syn_model in nc.nest.Models())
 
-    def test_make_mask(self):
-        """ Client make Mask """
+    def test_make_network_specs_compact(self):
+        """ Client make network specs in compact format """
+        compact_spec = nc.network_specs.make_compact(nett_spec)
+        self.client.handle_make_network_specs(json.dumps(compact_spec))
+        self.client.ensure_network_built()
+        self.assertEqual(nc.nest.GetKernelStatus()['network_size'],
+                         2 + len(nett_spec['layers'][0]['neurons']))
+        gids = self.client.handle_get_gids(selection_json)
+        self.assertEqual(gids.tolist(), [64])
+
+    def test_parse_mixed_key_order(self):
+        """ Parse neurons with keys in different orders """
+        layer = dict(nett_spec['layers'][0], neurons=[
+            {"x": 0.1, "y": 0.2, "z": 0.3},
+            {"z": 3, "y": 2, "x": 1},
+            {"y": 2, "x": 1, "z": 3}])
+        specs = nc.network_specs.parse(json.dumps(dict(nett_spec,
+                                                       layers=[layer])))
+        self.assertEqual(specs['layers'][0]['positions'].tolist(),
+                         [[0.1, 0.2, 0.3], [1, 2, 3], [1, 2, 3]])
+
+    def test_parse_nested_list(self):
+        """ Parse neurons containing lists """
+        layer = dict(nett_spec['layers'][0], neurons=[
+            {"x": 0.1, "y": 0.2, "z": 0.3, "tags": [1, 2]},
+            {"x": 1, "y": 2, "z": 3, "tags": []}])
+        specs = nc.network_specs.parse(json.dumps(dict(nett_spec,
+                                                       layers=[layer])))
+        self.assertEqual(specs['layers'][0]['positions'].tolist(),
+                         [[0.1, 0.2, 0.3], [1, 2, 3]])
+
+    def test_make_network_specs_invalid(self):
+        """ Client make network specs with invalid specs """
+        invalid_spec = dict(nett_spec, projections=[
+            ["exAndIn", "missing", nett_spec['projections'][0][2]]])
+        with self.assertRaises(ValueError):
+            self.client.handle_make_network_specs(json.dumps(invalid_spec))
+
+    def test_make_mask_spec(self):
+        """ Client make Mask from mask specs """
         self.client.handle_make_network_specs(nett_spec_json)
+        self.client.ensure_network_built()
         lower_left = [-0.1, -0.1, -0.1]
         upper_right = [0.1, 0.1, 0.1]
         mask_type = 'box'
         azimuth_angle = 0.0
         polar_angle = 0.0
         cntr = [0.0, 0.0, 0.0]
-        mask = self.client.make_mask(lower_left, upper_right, mask_type,
-                                     azimuth_angle, polar_angle, cntr)
+        spec = nc.network_specs.make_mask_spec(lower_left, upper_right,
+                                               mask_type, azimuth_angle,
+                                               polar_angle, cntr)
+        self.assertEqual(spec, {'lower_left': lower_left,
+                                'upper_right': upper_right,
+                                'azimuth_angle': azimuth_angle,
+                                'polar_angle': polar_angle})
+        mask = nc.tp.CreateMask(mask_type, spec)
         gids = nc.tp.SelectNodesByMask((1,), cntr, mask)
         self.assertEqual(gids, (64,))
 
@@ -87,7 +144,74 @@ class TestNESTClient(unittest.TestCase):
         """ Client get GIDs """
         self.client.handle_make_network_specs(nett_spec_json)
         gids = self.client.handle_get_gids(selection_json)
-        self.assertEqual(gids, [64])
+        self.assertEqual(gids.tolist(), [64])
+
+    def test_get_gid_positions(self):
+        """ Client get positions of GIDs """
+        self.client.handle_make_network_specs(nett_spec_json)
+        self.client.ensure_network_built()
+        gids = nc.np.array([2, 64, 126])
+        self.assertEqual(
+            self.client.get_gid_positions(gids).tolist(),
+            [list(position) for position in nc.tp.GetPosition(gids.tolist())])
+
+    def test_get_gids_batch(self):
+        """ Client get GIDs of several selections """
+        self.client.handle_make_network_specs(nett_spec_json)
+        empty = dict(selection, neuronType='inhibitory')
+        results = self.client.handle_get_gids_batch(
+            json.dumps([selection, empty, selection]))
+        self.assertEqual(results,
+                         [{'count': 1, 'min_gid': 64, 'max_gid': 64},
+                          {'count': 0, 'min_gid': None, 'max_gid': None},
+                          {'count': 1, 'min_gid': 64, 'max_gid': 64}])
+
+    def test_spatial_index(self):
+        """ Client spatial index selects as SelectNodesByMask """
+        layer_2D = dict(nett_spec['layers'][0],
+                        neurons=[n for n in nett_spec['layers'][0]['neurons']
+                                 if n['z'] == 0.0],
+                        center=[0.0, 0.0], extent=[5.0, 5.0])
+        spec_2D = dict(nett_spec, layers=[layer_2D], is3DLayer=False)
+        for spec, mask_types, cntr in [
+                (nett_spec, ['box', 'ellipsoidal'], [0.0, 0.0, 0.0]),
+                (spec_2D, ['rectangular', 'elliptical'], [0.0, 0.0])]:
+            self.client.handle_reset()
+            self.client.handle_make_network_specs(json.dumps(spec))
+            self.client.ensure_network_built()
+            layer = self.client.layers['exAndIn']
+            index = self.client.selector.get_spatial_index('exAndIn')
+            for mask_type in mask_types:
+                for azimuth_angle, polar_angle in [(0., 0.), (30., 0.),
+                                                   (45., 60.)]:
+                    if len(cntr) == 2 and polar_angle:
+                        continue
+                    mask_spec = nc.network_specs.make_mask_spec(
+                        [-1.5, -0.5, -1.0], [1.0, 2.0, 1.5], mask_type,
+                        azimuth_angle, polar_angle, cntr)
+                    mask = nc.tp.CreateMask(mask_type, mask_spec)
+                    gids = sorted(nc.tp.SelectNodesByMask(layer, cntr, mask))
+                    positions = index.select(mask_type, mask_spec, cntr)
+                    self.assertTrue(gids)
+                    self.assertEqual((positions + layer[0] + 1).tolist(),
+                                     gids)
+
+    def test_selection_cache(self):
+        """ Client selection cache """
+        cache = self.client.selection_cache
+        self.client.handle_make_network_specs(nett_spec_json)
+        self.client.handle_recv_projections(projections_json)
+        hits, misses = cache.hits, cache.misses
+        self.client.handle_connect()
+        # Both devices have the same selection.
+        self.assertEqual((cache.hits - hits, cache.misses - misses), (1, 1))
+        self.assertEqual(
+            self.client.handle_get_gids(selection_json).tolist(), [64])
+        self.assertEqual((cache.hits - hits, cache.misses - misses), (2, 1))
+        # A rebuilt network has new GIDs.
+        self.client.handle_reset()
+        self.client.handle_get_gids(selection_json)
+        self.assertEqual((cache.hits - hits, cache.misses - misses), (2, 2))
 
     def test_connect_with_internal_only(self):
         """ Client connect internal only """
@@ -96,6 +220,47 @@ class TestNESTClient(unittest.TestCase):
         self.client.handle_connect()
         self.assertEqual(nc.nest.GetKernelStatus()['num_connections'], 1558)
 
+    def test_connectome_cache(self):
+        """ Client connect with connectome cache """
+        cache_dir = tempfile.mkdtemp()
+        self.client.connectome_cache = nc.ConnectomeCache(cache_dir, 2**20)
+        try:
+            self.client.handle_make_network_specs(nett_spec_json)
+            self.client.handle_connect()
+            connections = self.client.get_connectome()
+            # Build again, restoring the connections from the cache.
+            self.client.handle_reset()
+            self.client.handle_make_network_specs(nett_spec_json)
+            self.client.handle_connect()
+            restored = self.client.get_connectome()
+        finally:
+            self.client.connectome_cache = None
+            shutil.rmtree(cache_dir)
+        self.assertEqual(nc.nest.GetKernelStatus()['num_connections'], 1558)
+        for name in ['source', 'target', 'weight', 'delay', 'receptor']:
+            self.assertEqual(sorted(connections[name]),
+                             sorted(restored[name]))
+
+    def test_connectome_cache_repeatable(self):
+        """ Client simulates the same with connections from the cache """
+        cache_dir = tempfile.mkdtemp()
+        self.client.connectome_cache = nc.ConnectomeCache(cache_dir, 2**20)
+        results = []
+        try:
+            for run in range(2):
+                self.client.handle_reset()
+                self.client.handle_make_network_specs(nett_spec_json)
+                self.client.handle_recv_projections(projections_json)
+                self.client.handle_connect()
+                self.client.handle_simulate(150)
+                self.client.handle_simulate('-1')
+                results.append(self.client.last_results[
+                    'spike_detector_2']['times'].tolist())
+        finally:
+            self.client.connectome_cache = None
+            shutil.rmtree(cache_dir)
+        self.assertEqual(results[0], results[1])
+
     def test_connect_all(self):
         """ Client connect all """
         # Internal network and two devices connected to a neuron.
@@ -104,6 +269,61 @@ class TestNESTClient(unittest.TestCase):
         self.client.handle_connect()
         self.assertEqual(nc.nest.GetKernelStatus()['num_connections'], 1560)
 
+    def test_reconnect_devices(self):
+        """ Client reconnect devices only """
+        self.client.handle_make_network_specs(nett_spec_json)
+        self.client.handle_recv_projections(projections_json)
+        self.client.handle_connect()
+        # Unchanged devices are kept.
+        self.client.handle_recv_projections(projections_json)
+        self.client.handle_connect()
+        self.assertEqual(nc.nest.GetKernelStatus()['num_connections'], 1560)
+        self.assertEqual(len(self.client.retired_devices), 0)
+        # The projections are kept as they were received.
+        self.assertEqual(
+            self.client.devices['poisson_generator_1'][0],
+            projections['poisson_generator_1'])
+        self.assertIsInstance(self.client.devices['poisson_generator_1'][0]
+                              ['specs']['params']['rate'], int)
+        # Removed devices are retired, and the network is not rebuilt.
+        self.client.handle_recv_projections(json.dumps({}))
+        self.client.handle_connect()
+        self.assertEqual(nc.nest.GetKernelStatus()['num_connections'], 1560)
+        self.assertEqual(len(self.client.retired_devices), 2)
+
+    def test_reconnect_devices_threads(self):
+        """ Client reconnects devices only after the threads are changed """
+        self.client.handle_make_network_specs(nett_spec_json)
+        self.client.handle_recv_projections(projections_json)
+        self.client.handle_connect()
+        self.client.handle_set_threads('2')
+        self.assertTrue(self.client.can_reconnect_devices())
+        self.client.handle_connect()
+        self.assertEqual(nc.nest.GetKernelStatus('local_num_threads'), 1)
+        self.client.handle_set_threads('1')
+
+    def test_reconnect_devices_repeatable(self):
+        """ Client simulates the same after reconnecting devices only """
+        self.client.handle_make_network_specs(nett_spec_json)
+        self.client.handle_recv_projections(projections_json)
+        results = []
+        for run in range(2):
+            self.client.handle_connect()
+            self.client.handle_simulate(150)
+            self.client.handle_simulate('-1')
+            results.append(
+                self.client.last_results['spike_detector_2']['times'].tolist())
+        self.assertEqual(results[0], results[1])
+
+    def test_reconnect_devices_plastic(self):
+        """ Client rebuilds networks with plastic synapses """
+        plastic_spec = dict(nett_spec, syn_models=nett_spec['syn_models'] + [
+            ["stdp_synapse", "stdp_excitatory", {}]])
+        self.client.handle_make_network_specs(json.dumps(plastic_spec))
+        self.client.handle_recv_projections(projections_json)
+        self.client.handle_connect()
+        self.assertFalse(self.client.can_reconnect_devices())
+
     def test_simulate(self):
         """ Client simulate """
         self.client.handle_make_network_specs(nett_spec_json)
@@ -111,7 +331,146 @@ class TestNESTClient(unittest.TestCase):
         self.client.handle_connect()
         self.client.handle_simulate(150)
 
-        results = self.client.last_results
-        self.assertDictEqual(results, {'spike_detector_2': {'64': [109.4]}})
+        results = self.client.last_results['spike_detector_2']
+        self.assertEqual(results['senders'].tolist(), [64])
+        self.assertEqual(results['times'].tolist(), [109.4])
+
+    def test_simulate_error(self):
+        """ Client simulate sends an error result if it fails """
+        self.client.handle_make_network_specs(nett_spec_json)
+        slot = RecordingSlot()
+        mock_slot = self.client.results_sender.slot
+        self.client.results_sender.slot = slot
+        try:
+            with self.assertRaises(ValueError) as context:
+                self.client.handle_simulate('invalid')
+            self.client.send_error_replies(context.exception)
+            self.client.results_sender.wait_until_sent()
+        finally:
+            self.client.results_sender.slot = mock_slot
+            self.client.handle_simulate('-1')
+        self.assertEqual(len(slot.values), 1)
+        self.assertTrue(slot.values[0].startswith(nc.ERROR_RESULT_PREFIX))
+        # No error is sent if no results are waited for.
+        self.client.send_error_replies(context.exception)
+        self.assertFalse(self.client.awaiting_results)
+
+    def test_set_threads(self):
+        """ Client set threads """
+        self.client.handle_set_threads('2')
+        self.client.handle_reset()
+        self.assertEqual(nc.nest.GetKernelStatus('local_num_threads'), 2)
+        self.client.handle_set_threads('1')
+        self.client.handle_reset()
+        self.assertEqual(nc.nest.GetKernelStatus('local_num_threads'), 1)
+
+    def test_timings(self):
+        """ Client timings of connect """
+        self.client.handle_make_network_specs(nett_spec_json)
+        self.client.handle_recv_projections(projections_json)
+        self.client.handle_command('connect', '')
+        phases = [record['phase'] for record in self.client.timings]
+        for phase in ['reset_kernel', 'make_models', 'make_nodes',
+                      'make_synapse_models', 'connect_layers',
+                      'create_device', 'get_gids', 'connect_device']:
+            self.assertIn(phase, phases)
+        connect_layers = phases.index('connect_layers')
+        self.assertEqual(
+            self.client.timings[connect_layers]['connections'], 1558)
+        for record in self.client.timings:
+            self.assertGreaterEqual(record['time'], 0.)
+
+    def test_element_ranges(self):
+        """ Element ranges of layers with several elements """
+        self.assertDictEqual(
+            nc.network_specs.get_element_ranges(('L23pyr', 2, 'L23in', 1)),
+            {'L23pyr': (0, 2), 'L23in': (2, 3)})
+        self.assertDictEqual(
+            nc.network_specs.get_element_ranges(('Relay', 'Inter')),
+            {'Relay': (0, 1), 'Inter': (1, 2)})
+
+
+class TestMergeDeviceResults(unittest.TestCase):
+    def make_results(self, senders, times, vm_sender, vm_times, vm):
+        lfp_det = {str(i): {'lfp': nc.np.array([])} for i in range(16)}
+        lfp_det['times'] = nc.np.array([])
+        events = {'senders': nc.np.array(senders), 'times': nc.np.array(times)}
+        return {'stream_results': {'spike_detector_1': events},
+                'plot_results': {
+                    'spike_det': events,
+                    'rec_dev': {'times': nc.np.array(vm_times),
+                                'senders': nc.np.array([vm_sender]),
+                                'V_m': nc.np.array([[v] for v in vm])},
+                    'lfp_det': lfp_det,
+                    'time': 10.}}
+
+    def test_merge(self):
+        """ Merge device results from MPI ranks """
+        results = json.loads(nc.encode_results_json(nc.merge_device_results(
+            [self.make_results([1, 1], [0.5, 0.6], 2, [1., 2.], [-70., -69.]),
+             None,
+             self.make_results([5], [0.7], 6, [1.], [-65.])])))
+        self.assertDictEqual(results['stream_results'],
+                             {'spike_detector_1': {'senders': [1, 1, 5],
+                                                   'times': [0.5, 0.6, 0.7]}})
+        self.assertEqual(results['plot_results']['spike_det']['senders'],
+                         [1, 1, 5])
+        self.assertDictEqual(results['plot_results']['rec_dev'],
+                             {'times': [1., 2.],
+                              'senders': [2, 6],
+                              'V_m': [[-70., -65.], [-69., None]]})
+        self.assertIsNone(nc.merge_device_results([None, None]))
+
+    def test_group_by_time(self):
+        """ Group voltmeter values by time """
+        times, senders, matrix = nc.group_by_time(
+            nc.np.array([2., 1., 1., 2.]), nc.np.array([4, 4, 3, 3]),
+            nc.np.array([-68., -70., -65., -63.]))
+        self.assertEqual(times.tolist(), [1., 2.])
+        self.assertEqual(senders.tolist(), [3, 4])
+        self.assertEqual(matrix.tolist(), [[-65., -70.], [-63., -68.]])
+
+
+class RecordingSlot(object):
+    def __init__(self):
+        self.values = []
+
+    def send(self, data):
+        msg = nc.sm.string_message()
+        msg.ParseFromString(data)
+        self.values.append(msg.value)
+
+
+class TestSendSlot(unittest.TestCase):
+    def test_send_error(self):
+        """ Send slot keeps running after a failed send """
+        slot = RecordingSlot()
+        sender = nc.send_slot(slot)
+        sender.start()
+
+        def failing_encode(data):
+            raise ValueError('cannot encode')
+
+        sender.put({'a': 1}, failing_encode)
+        sender.put({'a': 2})
+        sender.wait_until_sent()
+        self.assertEqual(slot.values,
+                         [nc.ERROR_RESULT_PREFIX + 'ValueError: cannot encode',
+                          json.dumps({'a': 2})])
+
 
-    # TODO: Test getIndicesOfNeuronType.
+class TestConnectomeCache(unittest.TestCase):
+    def test_evict(self):
+        """ Connectome cache eviction keeps temporary files """
+        cache_dir = tempfile.mkdtemp()
+        try:
+            cache = nc.ConnectomeCache(cache_dir, 0)
+            temp_path = tempfile.mkstemp(
+                suffix='.npz', prefix=nc.CONNECTOME_TEMP_PREFIX,
+                dir=cache_dir)[1]
+            cache.save('0123', {'source': nc.np.arange(10)})
+            self.assertEqual(nc.os.listdir(cache_dir),
+                             [nc.os.path.basename(temp_path)])
+            self.assertIsNone(cache.load('0123'))
+        finally:
+            shutil.rmtree(cache_dir)
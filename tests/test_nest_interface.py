@@ -1,4 +1,6 @@
 import unittest
+import time
+import gevent
 import nest_utils as nu
 import json
 
@@ -36,6 +38,44 @@ class TestNESTInterface(unittest.TestCase):
         """ NESTInterface print GIDs """
         self.ni.printGIDs(selection_json)
 
+    def test_gids_batch(self):
+        """ NESTInterface get GIDs of several selections """
+        results = self.ni.get_gids_batch(json.dumps([selection, selection]))
+        self.assertEqual(results,
+                         [{'count': 1, 'min_gid': 64, 'max_gid': 64}] * 2)
+
+    def test_gids_batch_error(self):
+        """ NESTInterface get GIDs of several selections fails """
+        with self.assertRaises(RuntimeError):
+            self.ni.get_gids_batch(json.dumps([{'invalid': True}]))
+
+    def test_preview_selection(self):
+        """ NESTInterface preview selection """
+        self.assertDictEqual(
+            self.ni.preview_selection(selection),
+            {'neurons': 1,
+             'layers': {'exAndIn': {'neurons': 1,
+                                    'types': {'excitatory': 1}}}})
+
+    def test_spec_hash(self):
+        """ NESTInterface network specifications hash """
+        self.assertEqual(self.ni.spec_hash,
+                         nu.hash_network_specs(nett_spec_json))
+        self.assertNotEqual(self.ni.spec_hash,
+                            nu.hash_network_specs(projections_json))
+
+    def test_spec_hash_invalid(self):
+        """ NESTInterface does not record the hash of invalid specs """
+        invalid_spec = json.dumps(dict(json.loads(nett_spec_json),
+                                       projections=[['exAndIn', 'missing',
+                                                     {}]]))
+        with self.assertRaises(ValueError):
+            self.ni.assign(1, invalid_spec, projections_json)
+        self.assertIsNone(self.ni.spec_hash)
+        self.ni.assign(1, nett_spec_json, projections_json)
+        self.assertEqual(self.ni.spec_hash,
+                         nu.hash_network_specs(nett_spec_json))
+
     def test_connect(self):
         """ NESTInterface connect all """
         self.ni.connect_all()
@@ -45,5 +85,161 @@ class TestNESTInterface(unittest.TestCase):
     def test_simulate(self):
         """ NESTInterface simulate """
         self.ni.connect_all()
-        self.ni.simulate(150)
-        # TODO: check results
+        results = json.loads(self.ni.simulate(150).get(timeout=10))
+        self.ni.simulate(-1)
+        self.assertDictEqual(results['stream_results'],
+                             {'spike_detector_2': {'senders': [64],
+                                                   'times': [109.4]}})
+
+    def test_simulate_pipelined(self):
+        """ NESTInterface simulate pipelined """
+        self.ni.connect_all()
+        first = self.ni.simulate(100)
+        second = self.ni.simulate(50)
+        first_results = json.loads(first.get(timeout=10))
+        second_results = json.loads(second.get(timeout=10))
+        self.ni.simulate(-1)
+        self.assertIsNone(first_results)
+        self.assertDictEqual(second_results['stream_results'],
+                             {'spike_detector_2': {'senders': [64],
+                                                   'times': [109.4]}})
+
+
+class TestNESTClientPool(unittest.TestCase):
+    def test_acquire(self):
+        """ NESTClientPool acquire """
+        pool = nu.NESTClientPool(1, silent=True)
+        for _ in range(100):
+            if pool.get_stats()['idle'] == 1:
+                break
+            time.sleep(0.1)
+        ni = pool.acquire(2, nett_spec_json)
+        stats = pool.get_stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 0)
+        self.assertEqual(ni.user_id, 2)
+        self.assertEqual(ni.client_id, -1)
+        self.assertGreater(stats['mean_spawn_time'], 0.)
+        ni.connect_all()
+        self.assertEqual(ni.get_num_connections(), 1558)
+
+    def test_acquire_invalid(self):
+        """ NESTClientPool acquire with invalid specs """
+        pool = nu.NESTClientPool(1, silent=True)
+        for _ in range(100):
+            if pool.get_stats()['idle'] == 1:
+                break
+            time.sleep(0.1)
+        idle = pool.idle[0]
+        invalid_spec = dict(nett_spec, projections=[
+            ["exAndIn", "missing", nett_spec['projections'][0][2]]])
+        with self.assertRaises(ValueError):
+            pool.acquire(2, json.dumps(invalid_spec))
+        self.assertIsNotNone(idle.client.poll())
+
+
+class TestClientPort(unittest.TestCase):
+    def test_pooled_ports(self):
+        """ Client ports of pooled clients """
+        user_ports = [nu.get_client_port(user_id)
+                      for user_id in range(1, 1001)]
+        pool_ports = [nu.get_client_port(-k) for k in range(1, 11)]
+        self.assertEqual(len(set(pool_ports)), len(pool_ports))
+        self.assertFalse(set(pool_ports) & set(user_ports))
+        self.assertEqual(nu.get_client_port(1), user_ports[0])
+
+
+class TestChunkScheduler(unittest.TestCase):
+    def test_first_chunk(self):
+        """ ChunkScheduler first chunk """
+        scheduler = nu.ChunkScheduler(100., first_dt=1.)
+        self.assertEqual(scheduler.next_dt(), 1.)
+
+    def test_grow_and_shrink(self):
+        """ ChunkScheduler grow and shrink """
+        scheduler = nu.ChunkScheduler(1000., target_rate=10., first_dt=1.)
+        scheduler.next_dt()
+        scheduler.update(0.01)  # Much faster than the target rate
+        self.assertEqual(scheduler.next_dt(), 2.)
+        scheduler.update(1.)  # Much slower than the target rate
+        self.assertEqual(scheduler.next_dt(), 1.)
+        scheduler.update(0.1, result_size=4 * scheduler.max_result_size)
+        self.assertEqual(scheduler.next_dt(), 0.5)
+
+    def test_total_time(self):
+        """ ChunkScheduler total time """
+        scheduler = nu.ChunkScheduler(20.3, first_dt=1.)
+        total = 0.
+        while not scheduler.done():
+            total += scheduler.next_dt()
+            scheduler.update(0.01)
+        self.assertAlmostEqual(total, 20.3)
+
+
+class MockSocketIO(object):
+    def __init__(self):
+        self.emitted = []
+
+    def emit(self, event, data, namespace=None):
+        self.emitted.append((event, data, namespace))
+
+
+class TestJobScheduler(unittest.TestCase):
+    def test_core_budget(self):
+        """ JobScheduler core budget """
+        socketio = MockSocketIO()
+        scheduler = nu.JobScheduler(2, socketio=socketio)
+        running = []
+        max_running = [0]
+
+        def job(user_id):
+            with scheduler.job(user_id):
+                running.append(user_id)
+                max_running[0] = max(max_running[0], len(running))
+                gevent.sleep(0.01)
+                running.remove(user_id)
+
+        gevent.joinall([gevent.spawn(job, i) for i in range(5)])
+        self.assertEqual(max_running[0], 2)
+        self.assertEqual(scheduler.cores_in_use, 0)
+        self.assertEqual(scheduler.get_queue_length(), 0)
+        self.assertIn(('queue', {'position': 3}, '/message/4'),
+                      socketio.emitted)
+        self.assertIn(('queue', {'position': 0}, '/message/4'),
+                      socketio.emitted)
+
+
+class TestCPUPlacement(unittest.TestCase):
+    def test_cpu_sets(self):
+        """ CPUPlacement CPU sets """
+        placement = nu.CPUPlacement(cpus=range(6))
+        self.assertEqual(placement.get_cpu_sets(1), [[0, 1, 2, 3, 4, 5]])
+        self.assertEqual(placement.get_cpu_sets(4),
+                         [[0, 1], [2, 3], [4], [5]])
+        self.assertEqual(placement.get_cpu_sets(8),
+                         [[0], [1], [2], [3], [4], [5], [0], [1]])
+        placement = nu.CPUPlacement(cpus=range(6), max_threads=2)
+        self.assertEqual(placement.get_cpu_sets(2), [[0, 1], [3, 4]])
+
+    def test_remove(self):
+        """ CPUPlacement remove unpins the session """
+        class FakeInterface(object):
+            def __init__(self):
+                self.cpus = []
+                self.unpinned = False
+
+            def set_cpus(self, cpus):
+                self.cpus = cpus
+
+            def unpin(self):
+                self.cpus = []
+                self.unpinned = True
+
+        placement = nu.CPUPlacement(cpus=range(4))
+        first, second = FakeInterface(), FakeInterface()
+        placement.add(1, first)
+        placement.add(2, second)
+        self.assertEqual(first.cpus, [0, 1])
+        placement.remove(2)
+        self.assertTrue(second.unpinned)
+        self.assertEqual(first.cpus, [0, 1, 2, 3])